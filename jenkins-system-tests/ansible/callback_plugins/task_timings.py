@@ -0,0 +1,71 @@
+# Records how long every task took on every host and dumps the timings as
+# JSON to the file named by $TASK_TIMINGS_PATH when the play ends.
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'task_timings'
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        self.path = os.environ.get('TASK_TIMINGS_PATH')
+        self.started = time.time()
+        self.tasks = []
+        self.current = None
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.current = {
+            'name': task.get_name(),
+            'path': task.get_path(),
+            'start': time.time(),
+            'hosts': {},
+        }
+        self.tasks.append(self.current)
+
+    v2_playbook_on_handler_task_start = v2_playbook_on_task_start
+
+    def _record(self, result, status):
+        if self.current is None:
+            return
+        self.current['hosts'][result._host.get_name()] = {
+            'status': status,
+            'duration': time.time() - self.current['start'],
+        }
+
+    def v2_runner_on_ok(self, result):
+        self._record(result, 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._record(result, 'failed')
+
+    def v2_runner_on_skipped(self, result):
+        self._record(result, 'skipped')
+
+    def v2_runner_on_unreachable(self, result):
+        self._record(result, 'unreachable')
+
+    def v2_playbook_on_stats(self, stats):
+        if not self.path:
+            return
+        for task in self.tasks:
+            task['duration'] = max(
+                [host['duration'] for host in task['hosts'].values()] or [0]
+            )
+        report = {
+            'duration': time.time() - self.started,
+            'tasks': self.tasks,
+            'slowest': [
+                task['name'] for task in sorted(
+                    self.tasks, key=lambda t: t['duration'], reverse=True
+                )[:10]
+            ],
+        }
+        with open(self.path, 'w') as f:
+            json.dump(report, f, indent=4)
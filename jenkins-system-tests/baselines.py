@@ -0,0 +1,228 @@
+import collections
+import os
+import sqlite3
+import subprocess
+import time
+
+import pytest
+
+import testlib
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS durations (
+    run_id INTEGER NOT NULL,
+    revision TEXT NOT NULL,
+    env_hash TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    name TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS durations_name ON durations (name, run_id);
+'''
+
+# Span categories whose durations are kept in the store, per test phase
+# and fixture plus the metrics recorded with timings.record_metric
+TRACKED_CATEGORIES = ['test', 'fixture', 'metric']
+
+Regression = collections.namedtuple(
+    'Regression', ['name', 'duration', 'median', 'mad', 'runs']
+)
+
+
+def git_revision(path='.'):
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=path, stderr=devnull
+            ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def durations_from_spans(spans):
+    """
+    name -> total duration of the tracked spans, e.g. 'fixture:env' or
+    'metric:build_queue_wait'.
+    """
+    durations = collections.defaultdict(float)
+    for span in spans:
+        if span.cat in TRACKED_CATEGORIES:
+            durations['%s:%s' % (span.cat, span.name)] += span.duration
+    return dict(durations)
+
+
+def merge_durations(runs):
+    """
+    Sums the durations of several parts of a run, e.g. of the pytest-xdist
+    workers, by name.
+    """
+    merged = collections.defaultdict(float)
+    for durations in runs:
+        for name, duration in durations.items():
+            merged[name] += duration
+    return dict(merged)
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class BaselineStore(object):
+    """
+    Append only SQLite store of the durations of every run, keyed by the
+    git revision and the digest of the environment definition. Runs
+    recorded at the same time, e.g. by concurrent CI jobs, wait up to
+    'timeout' seconds for each other.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        # transactions are begun explicitly, see record
+        self._conn = sqlite3.connect(
+            path, timeout=timeout, isolation_level=None
+        )
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def record(self, durations, revision, env_hash):
+        """
+        Appends a run, returns its id.
+        """
+        # the write lock is taken before the last id is read, so that
+        # concurrent runs get different ids
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._conn.execute(
+                'SELECT COALESCE(MAX(run_id), 0) + 1 FROM durations'
+            ).fetchone()
+            run_id = row[0]
+            now = time.time()
+            self._conn.executemany(
+                'INSERT INTO durations VALUES (?, ?, ?, ?, ?, ?)', [
+                    (run_id, revision, env_hash, now, name, duration)
+                    for name, duration in sorted(durations.items())
+                ]
+            )
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+        return run_id
+
+    def history(self, name, before_run, window, env_hash=None):
+        query = 'SELECT duration FROM durations WHERE name = ? AND run_id < ?'
+        params = [name, before_run]
+        if env_hash is not None:
+            query += ' AND env_hash = ?'
+            params.append(env_hash)
+        query += ' ORDER BY run_id DESC LIMIT ?'
+        params.append(window)
+        return [row[0] for row in self._conn.execute(query, params)]
+
+    def compare(
+        self,
+        durations,
+        before_run,
+        window=20,
+        min_runs=5,
+        threshold=3.0,
+        min_slowdown=0.1,
+        min_seconds=1.0,
+        env_hash=None,
+    ):
+        """
+        Returns the Regressions among 'durations' compared to the last
+        'window' runs before 'before_run'. A duration regressed if it's
+        more than 'threshold' scaled median absolute deviations above the
+        baseline median, and at least 'min_slowdown' (relative) and
+        'min_seconds' slower than it. Names with fewer than 'min_runs'
+        runs in the baseline are never flagged.
+        The baseline spans all environments unless 'env_hash' is given,
+        since a changed playbook is exactly what should be caught.
+        """
+        regressions = []
+        for name, duration in sorted(durations.items()):
+            history = self.history(name, before_run, window, env_hash)
+            if len(history) < min_runs:
+                continue
+            median = _median(history)
+            # scaled to estimate the standard deviation of normal data
+            mad = 1.4826 * _median(
+                [abs(value - median) for value in history]
+            )
+            slowdown = duration - median
+            if slowdown < max(min_seconds, min_slowdown * median):
+                continue
+            if mad and slowdown / mad <= threshold:
+                continue
+            regressions.append(
+                Regression(name, duration, median, mad, len(history))
+            )
+        return regressions
+
+
+class BaselinePlugin(object):
+    """
+    Appends the durations the timing plugin recorded to a BaselineStore
+    at the end of the session and reports the regressions against the
+    preceding runs. With 'gate' set, a regression fails the session.
+    Under pytest-xdist the workers hand their durations to the controller,
+    which records them as a single run.
+    """
+
+    def __init__(self, path, timing_plugin, env_sources, gate=False):
+        self.path = path
+        self.timing_plugin = timing_plugin
+        self.env_sources = env_sources
+        self.gate = gate
+        self.regressions = []
+        self._worker_durations = []
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_testnodedown(self, node, error):
+        self._worker_durations.append(
+            getattr(node, 'workeroutput', {}).get('baseline_durations', {})
+        )
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_sessionfinish(self, session):
+        durations = durations_from_spans(self.timing_plugin.recorder.spans)
+        workeroutput = getattr(session.config, 'workeroutput', None)
+        if workeroutput is not None:
+            workeroutput['baseline_durations'] = durations
+            return
+
+        durations = merge_durations([durations] + self._worker_durations)
+        if not durations:
+            return
+
+        store = BaselineStore(self.path)
+        try:
+            run_id = store.record(
+                durations, git_revision(),
+                testlib.tree_digest(*self.env_sources)
+            )
+            self.regressions = store.compare(durations, run_id)
+        finally:
+            store.close()
+        if self.regressions and self.gate:
+            session.exitstatus = 1
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.regressions:
+            return
+
+        terminalreporter.section('performance regressions', red=True)
+        for regression in self.regressions:
+            terminalreporter.write_line(
+                '%8.2fs (baseline %.2fs +- %.2fs over %d runs) %s' % (
+                    regression.duration, regression.median, regression.mad,
+                    regression.runs, regression.name
+                )
+            )
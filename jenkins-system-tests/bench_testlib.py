@@ -0,0 +1,240 @@
+'''
+
+Benchmarks of testlib against an in process fake Jenkins, no VMs needed.
+In order to run them cd into jenkins-system-tests and run:
+    python -m pytest -v bench_testlib.py
+
+'''
+import functools
+import itertools
+import uuid
+
+import jenkins
+import pytest
+
+import fake_jenkins
+import jenkins_client
+import job_factory
+import reconciler
+import testlib
+
+FAST_POLICY = testlib.WaitPolicy(first_delay=0.001, max_delay=0.01)
+
+
+@pytest.fixture(scope='module')
+def fake():
+    with fake_jenkins.FakeJenkins(
+        build_duration=0.05, node_online_delay=0.05, restart_delay=0.2
+    ) as server:
+        yield server
+
+
+@pytest.fixture(scope='module')
+def jenkins_api(fake):
+    client = jenkins_client.PooledJenkins(fake.url, 'admin', 'admin')
+    yield client
+    client.close()
+
+
+@pytest.fixture(scope='module')
+def caching_jenkins_api(fake):
+    client = jenkins_client.CachingJenkins(fake.url, 'admin', 'admin')
+    yield client
+    client.close()
+
+
+@pytest.fixture(scope='module')
+def labeled_nodes(fake):
+    names = ['bench-slave-%d' % i for i in range(4)]
+    for name in names:
+        fake.add_node(name, labels='bench', executors=4)
+    return names
+
+
+@pytest.fixture(scope='module')
+def bench_job(jenkins_api, labeled_nodes):
+    reconciler.reconcile(
+        jenkins_api, {
+            'jobs': {
+                'bench_job':
+                    job_factory.JobTemplate(jenkins.EMPTY_CONFIG_XML).render(
+                        label='bench', concurrent=True
+                    )
+            }
+        }
+    )
+    return 'bench_job'
+
+
+def test_assert_true_within_polls(benchmark):
+    def _run():
+        polls = itertools.count()
+        testlib.assert_true_within(
+            lambda: next(polls) >= 20, 10, policy=FAST_POLICY
+        )
+
+    benchmark(_run)
+
+
+def test_allow_exceptions_within_injected_failures(
+    benchmark, fake, jenkins_api
+):
+    def _setup():
+        fake.fail_next(3)
+
+    benchmark.pedantic(
+        testlib.allow_exceptions_within_timeout,
+        args=(
+            jenkins_api.get_whoami, 10, [jenkins.JenkinsException],
+            FAST_POLICY
+        ),
+        setup=_setup,
+        rounds=20
+    )
+
+
+def test_get_whoami_pooled(benchmark, jenkins_api):
+    benchmark(jenkins_api.get_whoami)
+
+
+def test_get_whoami_cached(benchmark, caching_jenkins_api):
+    benchmark(caching_jenkins_api.get_whoami)
+
+
+def test_job_exists_cached(benchmark, caching_jenkins_api):
+    benchmark(caching_jenkins_api.job_exists, 'cached_job')
+
+
+def test_cache_invalidated_by_writes(caching_jenkins_api):
+    name = 'invalidated_job_%s' % uuid.uuid4().hex
+    _uuid = str(uuid.uuid4())
+    assert not caching_jenkins_api.job_exists(name)
+    assert not testlib.has_credentials_on_jenkins(caching_jenkins_api, _uuid)
+
+    caching_jenkins_api.create_job(name, jenkins.EMPTY_CONFIG_XML)
+    testlib.add_credentials_on_jenkins(caching_jenkins_api, _uuid)
+
+    assert caching_jenkins_api.job_exists(name)
+    assert testlib.has_credentials_on_jenkins(caching_jenkins_api, _uuid)
+    assert caching_jenkins_api.cache_stats()['invalidations'] > 0
+
+
+def test_wait_until_jenkins_is_available(benchmark, jenkins_api):
+    benchmark(
+        testlib.wait_until_jenkins_is_available,
+        jenkins_api,
+        policy=FAST_POLICY
+    )
+
+
+def test_restart_and_wait(benchmark, jenkins_api):
+    result = benchmark.pedantic(
+        testlib.restart_jenkins_and_wait,
+        args=(jenkins_api, ),
+        kwargs={'policy': FAST_POLICY},
+        rounds=3
+    )
+    assert result.downtime > 0
+
+
+@pytest.mark.parametrize('reload_delay', [0, 0.2])
+def test_reload_and_wait(fake, jenkins_api, reload_delay):
+    fake.reload_delay = reload_delay
+    previous = testlib.get_jenkins_instance_id(jenkins_api)
+    try:
+        result = testlib.restart_jenkins_and_wait(
+            jenkins_api, reload=True, policy=FAST_POLICY
+        )
+    finally:
+        fake.reload_delay = 0
+
+    assert result.instance_id == previous
+    assert result.downtime < reload_delay + 1
+    assert reload_delay <= result.elapsed < reload_delay + 1
+
+
+def test_reconcile_credentials(benchmark, jenkins_api):
+    def _setup():
+        credentials = dict(
+            (str(uuid.uuid4()), {}) for _ in range(10)
+        )
+        return ((jenkins_api, {'credentials': credentials}), {})
+
+    benchmark.pedantic(
+        reconciler.reconcile, setup=_setup, rounds=10
+    )
+
+
+def test_provision_nodes_until_online(benchmark, jenkins_api):
+    rounds = itertools.count()
+
+    def _setup():
+        nodes = dict(
+            (
+                'node-%d-%d' % (next(rounds), i),
+                reconciler.ssh_node('10.0.0.%d' % i, 'cred', 'bench')
+            ) for i in range(20)
+        )
+        return ((nodes, ), {})
+
+    def _provision(nodes):
+        reconciler.reconcile(jenkins_api, {'nodes': nodes})
+        testlib.assert_nodes_online_within(
+            jenkins_api, list(nodes), 10, policy=FAST_POLICY
+        )
+
+    benchmark.pedantic(_provision, setup=_setup, rounds=5)
+
+
+def test_reconcile_plugins_waits_for_downloads(fake, jenkins_api):
+    fake.plugin_install_delay = 0.3
+    try:
+        applied = reconciler.reconcile(jenkins_api, {'plugins': ['git']})
+    finally:
+        fake.plugin_install_delay = 0
+
+    assert [change.name for change in applied] == ['git']
+    assert reconciler.Reconciler(jenkins_api).plan({'plugins': ['git']}) == [
+        []
+    ]
+
+
+def test_reconcile_node_host_change(jenkins_api):
+    nodes = {'moved-node': reconciler.ssh_node('10.1.0.1', 'cred')}
+    reconciler.reconcile(jenkins_api, {'nodes': nodes})
+    nodes['moved-node'] = reconciler.ssh_node('10.1.0.2', 'cred')
+    moved = reconciler.reconcile(jenkins_api, {'nodes': nodes})
+    nodes['moved-node'] = reconciler.ssh_node('10.1.0.2', 'other-cred')
+    recredentialed = reconciler.reconcile(jenkins_api, {'nodes': nodes})
+
+    assert [change.name for change in moved] == ['moved-node']
+    assert [change.name for change in recredentialed] == ['moved-node']
+    assert reconciler.reconcile(jenkins_api, {'nodes': nodes}) == []
+
+
+@pytest.mark.parametrize('builds', [1, 20])
+def test_build_tracking_throughput(benchmark, jenkins_api, bench_job, builds):
+    def _run():
+        tracker = testlib.BuildTracker(jenkins_api)
+        for _ in range(builds):
+            tracker.trigger(bench_job)
+        return tracker.wait(30, policy=FAST_POLICY)
+
+    tracked = benchmark.pedantic(_run, rounds=3)
+    assert all(build.result == 'SUCCESS' for build in tracked)
+
+
+def test_assert_all_true_within_concurrent_conditions(
+    benchmark, jenkins_api, labeled_nodes
+):
+    conditions = dict(
+        (
+            name,
+            functools.partial(
+                lambda name: testlib.get_nodes(jenkins_api).online(name), name
+            )
+        ) for name in labeled_nodes
+    )
+    benchmark(
+        testlib.assert_all_true_within, conditions, 10, policy=FAST_POLICY
+    )
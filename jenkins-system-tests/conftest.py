@@ -2,13 +2,161 @@ import pytest
 import os
 import shutil
 
+import events
+import ssh_pool
+import timings
+import baselines
+import fake_jenkins
+import fake_lago
+import env_pool
+import testlib
 
-@pytest.fixture(scope='module')
-def module_results_path(request):
-    current_dir = os.path.abspath(os.getcwd())
-    results_path = os.path.join(
-        current_dir, 'test_results', str(request.module.__name__)
+
+def pytest_addoption(parser):
+    parser.addoption(
+        '--events-address',
+        default=None,
+        help=(
+            'Address on which the Jenkins master can reach this host. '
+            'When given, build and node events are pushed to a local '
+            'listener and waits resolve as soon as they arrive.'
+        )
+    )
+    parser.addoption(
+        '--load-builds',
+        type=int,
+        default=0,
+        help=(
+            'Number of builds the load test triggers across the labeled '
+            'jobs, the load test is skipped when not given.'
+        )
+    )
+    parser.addoption(
+        '--load-rate',
+        type=float,
+        default=1,
+        help='Builds per second the load test triggers.'
+    )
+    parser.addoption(
+        '--timings-top',
+        type=int,
+        default=10,
+        help=(
+            'Number of the slowest fixtures, test phases, waits and '
+            'Jenkins requests summarized at the end of the session.'
+        )
+    )
+    parser.addoption(
+        '--baseline-db',
+        default=None,
+        help=(
+            'SQLite file to which the durations of this run are appended '
+            'and compared against the preceding runs.'
+        )
+    )
+    parser.addoption(
+        '--baseline-gate',
+        action='store_true',
+        help='Fail the run if it regressed against the baseline.'
+    )
+    parser.addoption(
+        '--env-pool',
+        type=int,
+        default=0,
+        help=(
+            'Lease the environment from a pool of this many deployed '
+            'environments, which are reset in the background once the '
+            'session returns them.'
+        )
+    )
+    parser.addoption(
+        '--env-pool-warm',
+        action='store_true',
+        help=(
+            'Deploy all the free environments of the pool which are not '
+            'deployed yet before leasing one.'
+        )
+    )
+    parser.addoption(
+        '--env-pool-dir',
+        default='/tmp/lago-env-pool',
+        help='Directory the pooled environments are kept in.'
+    )
+    parser.addoption(
+        '--fake-lago',
+        action='store_true',
+        help=(
+            'Run against in memory VMs backed by local directories and an '
+            'in process Jenkins instead of a Lago environment. Tests marked '
+            'with needs_vms are skipped.'
+        )
     )
+    parser.addoption(
+        '--fake-boot-latency',
+        type=float,
+        default=0,
+        help='Seconds every fake VM takes to start.'
+    )
+    parser.addoption(
+        '--fake-ssh-latency',
+        type=float,
+        default=0,
+        help='Seconds every SSH handshake with a fake VM takes.'
+    )
+    parser.addoption(
+        '--fake-slaves',
+        type=int,
+        default=None,
+        help=(
+            'Number of fake Jenkins slaves, cloned from the slaves of the '
+            'init config.'
+        )
+    )
+
+
+def pytest_configure(config):
+    timing_plugin = timings.TimingPlugin(config.getoption('--timings-top'))
+    config.pluginmanager.register(timing_plugin, 'lago-timings')
+
+    baseline_db = config.getoption('--baseline-db')
+    if baseline_db is not None:
+        tests_dir = os.path.dirname(os.path.realpath(__file__))
+        config.pluginmanager.register(
+            baselines.BaselinePlugin(
+                baseline_db,
+                timing_plugin,
+                [
+                    os.path.join(tests_dir, 'init-jenkins.yaml'),
+                    os.path.join(tests_dir, 'ansible'),
+                ],
+                gate=config.getoption('--baseline-gate'),
+            ), 'lago-baselines'
+        )
+
+
+def pytest_collection_modifyitems(config, items):
+    if not config.getoption('--fake-lago'):
+        return
+
+    skip = pytest.mark.skip(reason='needs real VMs, --fake-lago was given')
+    for item in items:
+        if 'needs_vms' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture(scope='session')
+def worker_id():
+    # Same as the pytest-xdist fixture, which isn't there without xdist
+    return os.environ.get('PYTEST_XDIST_WORKER', 'master')
+
+
+@pytest.fixture(scope='module')
+def module_results_path(request, worker_id):
+    results_root = os.path.join(os.path.abspath(os.getcwd()), 'test_results')
+    if worker_id != 'master':
+        # every worker owns its own tree, no worker deletes another's
+        results_root = os.path.join(results_root, worker_id)
+    results_path = os.path.join(results_root, str(request.module.__name__))
     if os.path.isdir(results_path):
         shutil.rmtree(results_path)
 
@@ -33,3 +181,106 @@ def func_results_path(request, cls_results_path):
     os.makedirs(results_path)
 
     return results_path
+
+
+@pytest.fixture(scope='session')
+def event_listener(request):
+    address = request.config.getoption('--events-address')
+    if address is None:
+        yield None
+        return
+
+    listener = events.EventListener(advertised_host=address)
+    listener.start()
+    yield listener
+    listener.stop()
+
+
+@pytest.fixture(scope='session', autouse=True)
+def ssh_sessions():
+    pool = ssh_pool.get_ssh_pool()
+    yield pool
+    pool.close_all()
+
+
+@pytest.fixture(scope='session')
+def fake_jenkins_server(request):
+    if not request.config.getoption('--fake-lago'):
+        yield None
+        return
+
+    server = fake_jenkins.FakeJenkins(plugins=['credentials', 'ssh-slaves'])
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope='session')
+def lago_sdk(request, tmpdir_factory):
+    """
+    lago.sdk, or a fake_lago.FakeSDK with --fake-lago.
+    """
+    if not request.config.getoption('--fake-lago'):
+        # imported here so that running without Lago only fails the tests
+        # which need it
+        from lago import sdk
+        return sdk
+
+    return fake_lago.FakeSDK(
+        str(tmpdir_factory.mktemp('fake-lago')),
+        boot_latency=request.config.getoption('--fake-boot-latency'),
+        ssh_latency=request.config.getoption('--fake-ssh-latency'),
+        slaves=request.config.getoption('--fake-slaves'),
+    )
+
+
+@pytest.fixture(scope='session')
+def jenkins_port(fake_jenkins_server):
+    if fake_jenkins_server is None:
+        return 8080
+
+    return fake_jenkins_server.port
+
+
+@pytest.fixture(scope='session')
+def env_lease(request, worker_id, lago_sdk, tmpdir_factory):
+    """
+    The environment the session runs on, leased from an env_pool.EnvPool
+    with --env-pool and the worker's own environment otherwise.
+    """
+    pool_size = request.config.getoption('--env-pool')
+    if not pool_size:
+        yield env_pool.Lease(
+            testlib.worker_config(
+                'init-jenkins.yaml', str(tmpdir_factory.mktemp('config')),
+                worker_id
+            ),
+            testlib.worker_workdir('/tmp/lago-workdir', worker_id),
+            testlib.worker_prefix_name(worker_id),
+        )
+        return
+
+    pool_dir = request.config.getoption('--env-pool-dir')
+    if request.config.getoption('--fake-lago'):
+        # fake environments don't outlive the session
+        pool_dir = str(tmpdir_factory.mktemp('env-pool'))
+    pool = env_pool.EnvPool(
+        lago_sdk, pool_dir, pool_size, 'init-jenkins.yaml',
+        ['init-jenkins.yaml', 'ansible']
+    )
+    # fake environments have nothing to deploy
+    if request.config.getoption('--env-pool-warm') and \
+            not request.config.getoption('--fake-lago'):
+        pool.warm('ansible/jenkins_playbook.yaml')
+    lease = pool.lease()
+    timings.record_metric(
+        'env_lease_wait',
+        lease.wait,
+        slot=lease.slot.index,
+        **pool.occupancy()
+    )
+    if lease.reset is not None:
+        # the reset of the slot after the session which used it last
+        timings.record_metric('env_reset', lease.reset, slot=lease.slot.index)
+    yield lease
+    pool.release(lease)
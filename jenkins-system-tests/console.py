@@ -0,0 +1,141 @@
+import os
+import threading
+
+import jenkins
+import requests
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request
+
+PROGRESSIVE_TEXT_PATH = (
+    'job/%(name)s/%(number)s/logText/progressiveText?start=%(start)s'
+)
+
+
+class _Log(object):
+    def __init__(self, build, path):
+        self.build = build
+        self.path = path
+        self.offset = 0
+        self.done = False
+        self.error = None
+
+
+class ConsoleStreamer(object):
+    """
+    Follows the console output of builds as they run and appends it to
+    '<output_dir>/<job>-<number>.log'. A single poller thread serves all
+    the followed builds, every 'interval' seconds it asks each live build
+    for the output since the last offset and streams it straight to disk.
+    Builds are TrackedBuilds or anything else with 'job' and 'number'
+    attributes; builds whose number isn't known yet are skipped until it
+    is. Requires a client whose jenkins_request returns the response,
+    like jenkins_client.PooledJenkins.
+    Failed fetches are retried on the next poll, the last error is kept
+    in 'last_error' and stop raises it for the builds whose output is
+    still incomplete because of it.
+    """
+
+    def __init__(self, jenkins_api, output_dir, interval=1):
+        self.jenkins_api = jenkins_api
+        self.output_dir = output_dir
+        self.interval = interval
+        self._logs = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_error = None
+
+    def follow(self, build):
+        with self._lock:
+            self._logs.append(_Log(build, None))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the poller after fetching whatever output is left.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.poll()
+        with self._lock:
+            failed = [
+                log for log in self._logs
+                if not log.done and log.error is not None
+            ]
+        if failed:
+            raise RuntimeError(
+                'incomplete console output of %s: %s' % (
+                    ', '.join(
+                        '{}-{}'.format(log.build.job, log.build.number)
+                        for log in failed
+                    ), failed[-1].error
+                )
+            )
+
+    def paths(self):
+        with self._lock:
+            return [log.path for log in self._logs if log.path is not None]
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                # keep following the builds, stop reports what failed
+                self.last_error = e
+            self._stop.wait(self.interval)
+
+    def poll(self):
+        """
+        Fetches the new output of every live build, returns the number of
+        builds which are still running.
+        """
+        with self._lock:
+            live = [log for log in self._logs if not log.done]
+        for log in live:
+            if log.build.number is None:
+                continue
+            try:
+                self._fetch(log)
+            except (
+                jenkins.JenkinsException, HTTPError, requests.RequestException
+            ) as e:
+                # The build isn't visible yet or Jenkins is restarting, the
+                # next poll resumes from the same offset
+                log.error = self.last_error = e
+            else:
+                log.error = None
+
+        return sum(1 for log in live if not log.done)
+
+    def _fetch(self, log):
+        if log.path is None:
+            log.path = os.path.join(
+                self.output_dir,
+                '{}-{}.log'.format(log.build.job, log.build.number)
+            )
+        url = self.jenkins_api._build_url(
+            PROGRESSIVE_TEXT_PATH, {
+                'name': log.build.job,
+                'number': log.build.number,
+                'start': log.offset,
+            }
+        )
+        response = self.jenkins_api.jenkins_request(Request(url), stream=True)
+        try:
+            with open(log.path, mode='ab') as f:
+                # drop what a failed fetch wrote past the last offset, it's
+                # fetched again from there
+                f.truncate(log.offset)
+                for chunk in response.iter_content(64 * 1024):
+                    f.write(chunk)
+        finally:
+            response.close()
+
+        log.offset = int(response.headers.get('X-Text-Size', log.offset))
+        log.done = response.headers.get('X-More-Data') != 'true'
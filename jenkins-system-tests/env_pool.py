@@ -0,0 +1,310 @@
+import collections
+import fcntl
+import functools
+import json
+import os
+import threading
+import time
+
+# Lago's, or its stand-in when Lago isn't installed
+from fake_lago import PrefixAlreadyExists
+import testlib
+
+NEW = 'new'
+CLEAN = 'clean'
+DIRTY = 'dirty'
+
+# Free slots are leased in this order, a clean one is ready right away
+# while a dirty one has to be reverted first
+_LEASE_ORDER = {CLEAN: 0, NEW: 1, DIRTY: 2}
+
+
+class Lease(object):
+    """
+    The Lago environment a session runs on: its init config, workdir and
+    prefix. 'snapshot' names the deployed snapshot the environment is at
+    when it's leased, if any, 'wait' is how long the lease took and
+    'reset' how long the last revert of the environment to its snapshot
+    took, if it was reverted.
+    """
+
+    def __init__(
+        self,
+        config,
+        workdir,
+        prefix_name,
+        snapshot=None,
+        wait=0,
+        reset=None,
+        slot=None,
+    ):
+        self.config = config
+        self.workdir = workdir
+        self.prefix_name = prefix_name
+        self.snapshot = snapshot
+        self.wait = wait
+        self.reset = reset
+        self.slot = slot
+
+
+class Slot(object):
+    """
+    A pooled environment, a Lago workdir guarded by an exclusive lock on
+    its lock file, which is held for as long as the slot is leased or
+    reset. The lock is released by the kernel if its holder dies.
+    """
+
+    def __init__(self, root, index):
+        self.index = index
+        self.path = os.path.join(root, 'slot-%d' % index)
+        self.workdir = os.path.join(self.path, 'workdir')
+        self.prefix_name = 'jenkins-pool-%d' % index
+        self._lock_file = None
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def try_lock(self):
+        lock_file = open(os.path.join(self.path, 'lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def unlock(self):
+        lock_file, self._lock_file = self._lock_file, None
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    def locked(self):
+        """
+        Whether the slot is locked by anyone, including this process.
+        """
+        if self._lock_file is not None or not self.try_lock():
+            return True
+        self.unlock()
+        return False
+
+    def _state_path(self):
+        return os.path.join(self.path, 'state.json')
+
+    def _load_state(self):
+        try:
+            with open(self._state_path(), mode='rt') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {'state': NEW}
+
+    def state(self):
+        """
+        Returns (state, snapshot), only to be trusted while locked.
+        """
+        state = self._load_state()
+        return state['state'], state.get('snapshot')
+
+    def last_reset(self):
+        """
+        How long the last reset of the slot took, None if there was none.
+        """
+        return self._load_state().get('reset')
+
+    def set_state(self, state, snapshot=None, reset=None):
+        path = self._state_path()
+        with open(path + '.tmp', mode='wt') as f:
+            json.dump(
+                {'state': state, 'snapshot': snapshot, 'reset': reset}, f
+            )
+        os.rename(path + '.tmp', path)
+
+
+class EnvPool(object):
+    """
+    'size' Lago environments of the init config 'config', kept in slots
+    under 'root' across sessions. Sessions lease a free slot, concurrent
+    sessions on the same host (e.g. pytest-xdist workers or CI jobs) never
+    share one, and every slot gets its own subnets, from 'first_octet' on
+    and apart from the ones testlib.worker_config gives xdist workers.
+    A returned environment is reverted to its deployed snapshot in the
+    background and is free once it's clean again, so the next lease
+    skips the deployment. 'sources' are the ones the Deployment of the
+    tests is named after.
+    """
+
+    def __init__(
+        self,
+        sdk,
+        root,
+        size,
+        config,
+        sources,
+        first_octet=testlib.POOL_FIRST_OCTET,
+    ):
+        self.sdk = sdk
+        self.root = root
+        self.config = config
+        self.sources = sources
+        self.first_octet = first_octet
+        self.slots = [Slot(root, index) for index in range(size)]
+        self.errors = []
+        self._resets = []
+
+    def _config(self, slot):
+        return testlib.isolated_config(
+            self.config,
+            slot.path,
+            slot.index,
+            self.first_octet,
+            last_octet=testlib.WORKER_FIRST_OCTET - 1,
+        )
+
+    def _load(self, slot, **kwargs):
+        try:
+            return self.sdk.init(
+                config=self._config(slot),
+                workdir=slot.workdir,
+                prefix_name=slot.prefix_name,
+                **kwargs
+            )
+        except PrefixAlreadyExists:
+            return self.sdk.load_env(workdir=slot.workdir, **kwargs)
+
+    def _try_lock_free(self):
+        slots = sorted(
+            self.slots, key=lambda slot: _LEASE_ORDER[slot.state()[0]]
+        )
+        for slot in slots:
+            if slot.try_lock():
+                return slot
+        return None
+
+    def _reset(self, slot):
+        """
+        Reverts the locked 'slot' to its deployed snapshot and keeps how
+        long that took in its state, the background resets finish after
+        their session is reported so the next lease reports it instead.
+        """
+        start = time.time()
+        env = self._load(slot)
+        env.start()
+        deployment = testlib.Deployment(env, *self.sources)
+        if deployment.restore():
+            slot.set_state(
+                CLEAN, deployment.snapshot_name, reset=time.time() - start
+            )
+        else:
+            slot.set_state(NEW)
+
+    def lease(self, timeout=testlib.LONG_TIMEOUT, policy=None):
+        """
+        Leases a free slot, waiting up to 'timeout' seconds for one.
+        The slot is marked dirty right away, so a slot whose session was
+        killed, or whose background reset never finished, is reset before
+        it's handed out again.
+        """
+        start = time.time()
+        result = testlib.get_wait_engine().wait(
+            self._try_lock_free,
+            timeout,
+            until=lambda slot: slot is not None,
+            policy=policy,
+        )
+        if not result.done:
+            raise RuntimeError(
+                'no environment of %s was free within %ds' %
+                (self.root, timeout)
+            )
+
+        slot = result.value
+        try:
+            if slot.state()[0] == DIRTY:
+                self._reset(slot)
+        except Exception:
+            slot.unlock()
+            raise
+        state, snapshot = slot.state()
+        reset = slot.last_reset()
+        slot.set_state(DIRTY)
+        return Lease(
+            self._config(slot),
+            slot.workdir,
+            slot.prefix_name,
+            snapshot=snapshot if state == CLEAN else None,
+            wait=time.time() - start,
+            reset=reset,
+            slot=slot,
+        )
+
+    def release(self, lease):
+        """
+        Returns a leased slot, which is reset in the background and freed
+        once it's clean. Sessions leasing meanwhile take other slots.
+        """
+        slot = lease.slot
+
+        def _reset():
+            try:
+                self._reset(slot)
+            except Exception as exc:
+                # left dirty, whoever leases it next resets it
+                self.errors.append(exc)
+            finally:
+                slot.unlock()
+
+        thread = threading.Thread(target=_reset)
+        thread.start()
+        self._resets.append(thread)
+
+    def _warm(self, slot, playbook):
+        try:
+            if slot.state()[0] == CLEAN:
+                return True
+            env = self._load(slot)
+            env.start()
+            deployment = testlib.Deployment(env, *self.sources)
+            if not deployment.restore():
+                result = testlib.deploy_ansible_playbook(env, playbook)
+                if result:
+                    raise RuntimeError(
+                        'deploying %s failed: %s' % (slot.path, result.err)
+                    )
+                deployment.save()
+            slot.set_state(CLEAN, deployment.snapshot_name)
+            return True
+        finally:
+            slot.unlock()
+
+    def warm(self, playbook):
+        """
+        Deploys 'playbook' on every free slot which isn't clean, all of
+        them at once, so that the next leases are ready right away.
+        """
+        slots = [slot for slot in self.slots if slot.try_lock()]
+        return testlib.run_concurrently(
+            [
+                functools.partial(self._warm, slot, playbook)
+                for slot in slots
+            ],
+            max_workers=max(len(slots), 1)
+        )
+
+    def wait_for_resets(self):
+        for thread in self._resets:
+            thread.join()
+        self._resets = []
+
+    def occupancy(self):
+        """
+        Returns a dict of the number of 'leased' (including the ones being
+        reset) slots and of the free slots in every state.
+        """
+        counts = collections.Counter(
+            dict((state, 0) for state in ['leased'] + list(_LEASE_ORDER))
+        )
+        for slot in self.slots:
+            if slot.locked():
+                counts['leased'] += 1
+            else:
+                counts[slot.state()[0]] += 1
+        return dict(counts)
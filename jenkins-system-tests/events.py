@@ -0,0 +1,199 @@
+import collections
+import itertools
+import json
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.request import Request, urlopen
+
+# Registers listeners on the master which POST build and node events, in
+# the same shape as the Jenkins notification plugin, to the given url.
+HOOKS_SCRIPT = '''
+import groovy.json.JsonOutput
+import hudson.model.Computer
+import hudson.model.Run
+import hudson.model.TaskListener
+import hudson.model.listeners.RunListener
+import hudson.slaves.ComputerListener
+import jenkins.model.Jenkins
+
+def post(Map event) {
+    def conn = new URL('%(url)s').openConnection()
+    conn.setRequestMethod('POST')
+    conn.setDoOutput(true)
+    conn.setConnectTimeout(2000)
+    conn.setRequestProperty('Content-Type', 'application/json')
+    conn.outputStream.withWriter { it << JsonOutput.toJson(event) }
+    conn.responseCode
+}
+
+class LagoNodeEvents extends ComputerListener {
+    Closure post
+    void onOnline(Computer c, TaskListener l) {
+        post([node: c.name, event: 'online'])
+    }
+    void onOffline(Computer c) {
+        post([node: c.name, event: 'offline'])
+    }
+}
+
+class LagoBuildEvents extends RunListener<Run> {
+    Closure post
+    void send(Run r, String phase) {
+        post([
+            name: r.parent.fullName,
+            build: [number: r.number, phase: phase,
+                    status: r.result?.toString()]
+        ])
+    }
+    void onStarted(Run r, TaskListener l) { send(r, 'STARTED') }
+    void onFinalized(Run r) { send(r, 'FINALIZED') }
+}
+
+def extensions = Jenkins.instance.getExtensionList(ComputerListener.class)
+extensions.removeAll { it.class.name == 'LagoNodeEvents' }
+extensions.add(new LagoNodeEvents(post: this.&post))
+extensions = Jenkins.instance.getExtensionList(RunListener.class)
+extensions.removeAll { it.class.name == 'LagoBuildEvents' }
+extensions.add(new LagoBuildEvents(post: this.&post))
+'''
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class EventListener(object):
+    """
+    Local HTTP endpoint which records the JSON events Jenkins posts to it.
+    Waits can use its waiters to wake up as soon as a relevant event
+    arrives instead of sleeping until their next poll. Only the last
+    'max_events' events are kept.
+    """
+
+    def __init__(
+        self, host='0.0.0.0', port=0, advertised_host=None, max_events=1000
+    ):
+        self.events = collections.deque(maxlen=max_events)
+        # number of events ever recorded, waiters count from it since the
+        # oldest events are dropped from 'events'
+        self.recorded = 0
+        self._cond = threading.Condition()
+        self._server = _Server((host, port), self._handler())
+        self.advertised_host = advertised_host or host
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(
+            self.advertised_host, self._server.server_port
+        )
+
+    def _handler(self):
+        listener = self
+
+        class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    event = json.loads(self.rfile.read(length).decode('utf-8'))
+                except ValueError:
+                    self.send_response(400)
+                else:
+                    listener.record(event)
+                    self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        return _Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def record(self, event):
+        with self._cond:
+            self.events.append(event)
+            self.recorded += 1
+            self._cond.notify_all()
+
+    def waiter(self, match):
+        """
+        Returns a callable which blocks for up to its 'timeout' argument,
+        returning True as soon as an event for which 'match(event)' holds
+        is recorded. Only events recorded after the previous call count,
+        of which the ones that were already dropped are missed.
+        """
+        with self._cond:
+            seen = [self.recorded]
+
+        def _wait(timeout):
+            deadline = time.time() + timeout
+            with self._cond:
+                while True:
+                    count = min(self.recorded - seen[0], len(self.events))
+                    new_events = itertools.islice(
+                        self.events, len(self.events) - count, None
+                    )
+                    seen[0] = self.recorded
+                    if any(match(event) for event in new_events):
+                        return True
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+
+        return _wait
+
+    def node_waiter(self, names, event='online'):
+        names = set(names)
+        return self.waiter(
+            lambda e: e.get('node') in names and e.get('event') == event
+        )
+
+    def build_waiter(self, jobs):
+        jobs = set(jobs)
+        return self.waiter(lambda e: 'build' in e and e.get('name') in jobs)
+
+
+def install_event_hooks(jenkins_api, url):
+    jenkins_api.run_script(HOOKS_SCRIPT % {'url': url})
+
+
+def notify(url, event):
+    """
+    Posts 'event' to a listener the same way the master hooks do, for
+    driving an EventListener without a Jenkins.
+    """
+    request = Request(
+        url,
+        json.dumps(event).encode('utf-8'),
+        {'Content-Type': 'application/json'},
+    )
+    urlopen(request, timeout=5).read()
+
+
+def notify_build(url, job, number, phase, status=None):
+    notify(
+        url, {
+            'name': job,
+            'build': {
+                'number': number,
+                'phase': phase,
+                'status': status
+            }
+        }
+    )
+
+
+def notify_node(url, node, event='online'):
+    notify(url, {'node': node, 'event': event})
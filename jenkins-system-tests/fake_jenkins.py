@@ -0,0 +1,710 @@
+import base64
+import json
+import random
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from six.moves import BaseHTTPServer, http_client, socketserver
+from six.moves.urllib.parse import parse_qs, unquote, urlparse
+
+import events
+
+VERSION = '2.60.1'
+
+# Every route is (method, path pattern, handler name), paths don't have
+# the leading slash and the query is matched separately
+ROUTES = [
+    ('GET', r'$', '_root'),
+    ('GET', r'login$', '_login'),
+    ('GET', r'crumbIssuer/api/json$', '_crumb'),
+    ('GET', r'me/api/json$', '_whoami'),
+    ('GET', r'api/json$', '_list_jobs'),
+    ('GET', r'pluginManager/api/json$', '_list_plugins'),
+    ('POST', r'pluginManager/installNecessaryPlugins$', '_install_plugins'),
+    ('GET', r'updateCenter/api/json$', '_update_center'),
+    ('GET', r'computer/api/json$', '_computers'),
+    ('POST', r'scriptText$', '_script'),
+    ('POST', r'createItem$', '_create_job'),
+    ('GET', r'job/(?P<job>[^/]+)/api/json$', '_job_info'),
+    ('GET', r'job/(?P<job>[^/]+)/config\.xml$', '_job_config'),
+    ('POST', r'job/(?P<job>[^/]+)/config\.xml$', '_reconfig_job'),
+    ('POST', r'job/(?P<job>[^/]+)/(build|buildWithParameters)$', '_build'),
+    ('GET', r'job/(?P<job>[^/]+)/(?P<number>\d+)/api/json$', '_build_info'),
+    (
+        'GET', r'job/(?P<job>[^/]+)/(?P<number>\d+)/logText/progressiveText$',
+        '_progressive_text'
+    ),
+    ('GET', r'queue/api/json$', '_list_queue'),
+    ('GET', r'queue/item/(?P<number>\d+)/api/json$', '_queue_item'),
+    (
+        'GET', r'credentials/store/system/domain/_/api/json$',
+        '_list_credentials'
+    ),
+    (
+        'POST', r'credentials/store/system/domain/_/createCredentials$',
+        '_create_credentials'
+    ),
+    (
+        'GET', r'credentials/store/system/domain/_/credential/'
+        r'(?P<id>[^/]+)/api/json$', '_credential'
+    ),
+    ('POST', r'(?P<kind>restart|safeRestart|reload)$', '_restart'),
+]
+
+
+class Response(object):
+    def __init__(self, status=200, body=b'', headers=None):
+        self.status = status
+        self.body = body if isinstance(body, bytes) else body.encode('utf-8')
+        self.headers = headers or {}
+
+
+def _json(obj, status=200):
+    return Response(
+        status, json.dumps(obj), {'Content-Type': 'application/json'}
+    )
+
+
+class _Node(object):
+    def __init__(
+        self,
+        name,
+        labels,
+        executors,
+        online_at,
+        host=None,
+        credentials_id=None,
+    ):
+        self.name = name
+        self.labels = labels
+        self.executors = executors
+        self.online_at = online_at
+        self.host = host
+        self.credentials_id = credentials_id
+        self.online = False
+
+
+class _Job(object):
+    def __init__(self, name, config_xml):
+        self.name = name
+        self.builds = []
+        self.next_number = 1
+        self.configure(config_xml)
+
+    def configure(self, config_xml):
+        self.config_xml = config_xml
+        root = ET.fromstring(config_xml.encode('utf-8'))
+        label = root.findtext('assignedNode')
+        self.label = label.strip() if label else None
+
+
+class _QueueItem(object):
+    def __init__(self, number, job, queued_at, ready_at):
+        self.number = number
+        self.job = job
+        self.queued_at = queued_at
+        self.ready_at = ready_at
+        self.build = None
+
+
+class _Build(object):
+    def __init__(self, job, number, node, started_at, finishes_at, result):
+        self.job = job
+        self.number = number
+        self.node = node
+        self.started_at = started_at
+        self.finishes_at = finishes_at
+        self.final_result = result
+        self.result = None
+        self.log = 'Started on %s\n' % node
+
+    @property
+    def building(self):
+        return self.result is None
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeJenkins(object):
+    """
+    In process HTTP server which answers the Jenkins endpoints used by
+    the suite: whoami, version, plugins, computers, the script console
+    (node provisioning, event hooks and the instance id), jobs, builds,
+    the queue, the credentials store and restarts.
+
+    State changes happen in the background as they would on a master:
+    nodes come online 'node_online_delay' seconds after they were
+    provisioned, queued builds become buildable after 'queue_delay' and
+    start once an online node with a matching label has a free executor,
+    builds run for 'build_duration' and fail with 'build_failure_rate'
+    probability. A restart answers 503 for 'restart_delay' seconds, a
+    reload for 'reload_delay' seconds right after it was requested.
+    Plugins are downloaded for 'plugin_install_delay' seconds and become
+    active with the next restart, a restart before that drops them.
+    Every request is delayed by 'latency' seconds, answered with a 500
+    with 'failure_rate' probability, or as set up by fail_next.
+    Authentication and crumbs are accepted but not checked.
+    """
+
+    def __init__(
+        self,
+        host='127.0.0.1',
+        port=0,
+        latency=0,
+        failure_rate=0,
+        queue_delay=0,
+        build_duration=0.1,
+        build_failure_rate=0,
+        node_online_delay=0,
+        restart_delay=0.5,
+        reload_delay=0,
+        plugin_install_delay=0,
+        master_executors=2,
+        plugins=None,
+        tick=0.01,
+        seed=None,
+    ):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.queue_delay = queue_delay
+        self.build_duration = build_duration
+        self.build_failure_rate = build_failure_rate
+        self.node_online_delay = node_online_delay
+        self.restart_delay = restart_delay
+        self.reload_delay = reload_delay
+        self.plugin_install_delay = plugin_install_delay
+        self.tick = tick
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._failures = []
+        self._started_at = time.time()
+        self._down_until = 0
+        # update center jobs, (plugin name, time its download is done)
+        self._installs = []
+        self._plugins = dict(
+            (name, True) for name in (plugins or ['credentials'])
+        )
+        self._nodes = {
+            'master': _Node('master', '', master_executors, 0),
+        }
+        self._jobs = {}
+        self._queue = []
+        self._queue_items = {}
+        self._next_queue_item = 1
+        self._credentials = {}
+        self._hooks_url = None
+        self._routes = [
+            (method, re.compile(pattern), getattr(self, handler))
+            for method, pattern, handler in ROUTES
+        ]
+        self._server = _Server((host, port), self._handler())
+        self._threads = []
+        self._stop = threading.Event()
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def start(self):
+        for target in [self._server.serve_forever, self._tick]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._server.shutdown()
+        self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def fail_next(self, count=1, status=500):
+        """
+        Answers the next 'count' requests with 'status'.
+        """
+        with self._lock:
+            self._failures.extend([status] * count)
+
+    def add_node(self, name, labels='', executors=1, online_delay=0):
+        with self._lock:
+            self._nodes[name] = _Node(
+                name, labels, executors, time.time() + online_delay
+            )
+
+    def add_job(self, name, config_xml):
+        with self._lock:
+            self._jobs[name] = _Job(name, config_xml)
+
+    # state transitions
+
+    def _tick(self):
+        while not self._stop.is_set():
+            self._advance()
+            self._stop.wait(self.tick)
+
+    def _advance(self):
+        notifications = []
+        with self._lock:
+            now = time.time()
+            for node in self._nodes.values():
+                if not node.online and node.online_at <= now:
+                    node.online = True
+                    notifications.append(
+                        {
+                            'node': node.name,
+                            'event': 'online'
+                        }
+                    )
+
+            for job in self._jobs.values():
+                for build in job.builds:
+                    if build.building and build.finishes_at <= now:
+                        build.result = build.final_result
+                        build.log += 'Finished: %s\n' % build.result
+                        notifications.append(self._build_event(build))
+
+            for item in list(self._queue):
+                if item.ready_at > now:
+                    continue
+                node = self._free_node(self._jobs[item.job].label)
+                if node is None:
+                    continue
+                self._queue.remove(item)
+                item.build = self._start_build(item, node, now)
+                notifications.append(self._build_event(item.build))
+
+        if self._hooks_url is not None:
+            for event in notifications:
+                try:
+                    events.notify(self._hooks_url, event)
+                except (IOError, http_client.HTTPException):
+                    # like the groovy hooks, an unreachable listener is
+                    # ignored
+                    pass
+
+    def _build_event(self, build):
+        return {
+            'name': build.job,
+            'build': {
+                'number': build.number,
+                'phase': 'STARTED' if build.building else 'FINALIZED',
+                'status': build.result,
+            }
+        }
+
+    def _free_node(self, label):
+        for name in sorted(self._nodes):
+            node = self._nodes[name]
+            if not node.online:
+                continue
+            if label and label not in node.labels.split() + [node.name]:
+                continue
+            if self._busy(node.name) < node.executors:
+                return node
+        return None
+
+    def _busy(self, name):
+        return sum(
+            1 for job in self._jobs.values() for build in job.builds
+            if build.building and build.node == name
+        )
+
+    def _start_build(self, item, node, now):
+        job = self._jobs[item.job]
+        failed = self._random.random() < self.build_failure_rate
+        build = _Build(
+            job.name, job.next_number, node.name, now,
+            now + self.build_duration, 'FAILURE' if failed else 'SUCCESS'
+        )
+        job.next_number += 1
+        job.builds.append(build)
+        return build
+
+    # HTTP
+
+    def _handler(self):
+        fake = self
+
+        class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, don't let them wait
+            # for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def _serve(self, method):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                response = fake.handle(method, self.path, body)
+                self.send_response(response.status)
+                for header, value in response.headers.items():
+                    self.send_header(header, value)
+                self.send_header('Content-Length', str(len(response.body)))
+                self.end_headers()
+                self.wfile.write(response.body)
+
+            def do_GET(self):
+                self._serve('GET')
+
+            def do_POST(self):
+                self._serve('POST')
+
+            def log_message(self, *args):
+                pass
+
+        return _Handler
+
+    def handle(self, method, raw_path, body):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(raw_path)
+        path = url.path.lstrip('/')
+        query = dict(
+            (key, values[0]) for key, values in parse_qs(url.query).items()
+        )
+        with self._lock:
+            self.requests += 1
+            if self._failures:
+                return Response(self._failures.pop(0), 'injected failure')
+            if self._random.random() < self.failure_rate:
+                return Response(500, 'injected failure')
+            if time.time() < self._down_until:
+                return Response(503, 'Jenkins is getting ready to work')
+
+            for route_method, pattern, handler in self._routes:
+                match = pattern.match(path)
+                if route_method == method and match:
+                    kwargs = dict(
+                        (key, unquote(value))
+                        for key, value in match.groupdict().items()
+                    )
+                    return handler(query, body, **kwargs)
+
+        return Response(404, 'Not found')
+
+    def _root(self, query, body):
+        return Response(200, '<html/>', {'X-Jenkins': VERSION})
+
+    def _login(self, query, body):
+        return Response(200, '<html/>')
+
+    def _crumb(self, query, body):
+        return _json({'crumbRequestField': 'Jenkins-Crumb', 'crumb': 'fake'})
+
+    def _whoami(self, query, body):
+        return _json({'id': 'admin', 'fullName': 'admin'})
+
+    def _list_jobs(self, query, body):
+        return _json(
+            {
+                'jobs': [
+                    {
+                        'name': name,
+                        'url': '%sjob/%s/' % (self.url, name),
+                        'color': 'blue' if job.builds else 'notbuilt',
+                    } for name, job in sorted(self._jobs.items())
+                ]
+            }
+        )
+
+    def _list_plugins(self, query, body):
+        plugins = dict(self._plugins)
+        now = time.time()
+        for name, done_at in self._installs:
+            if done_at <= now:
+                # installed, inactive until the restart
+                plugins.setdefault(name, False)
+        return _json(
+            {
+                'plugins': [
+                    {
+                        'shortName': name,
+                        'longName': name,
+                        'active': active,
+                        'enabled': True,
+                        'version': '1.0',
+                    } for name, active in sorted(plugins.items())
+                ]
+            }
+        )
+
+    def _install_plugins(self, query, body):
+        done_at = time.time() + self.plugin_install_delay
+        for name in re.findall(r'plugin="([^@"]+)', body.decode('utf-8')):
+            self._installs.append((name, done_at))
+        return Response(200)
+
+    def _update_center(self, query, body):
+        now = time.time()
+        jobs = []
+        for index, (name, done_at) in enumerate(self._installs):
+            status = 'SuccessButRequiresRestart' if done_at <= now \
+                else 'Installing'
+            jobs.append(
+                {
+                    'id': index + 1,
+                    'type': 'InstallationJob',
+                    'name': name,
+                    'status': {
+                        'type': status,
+                        'success': done_at <= now,
+                    },
+                }
+            )
+        return _json({'jobs': jobs})
+
+    def _computers(self, query, body):
+        computers = []
+        busy_total = 0
+        for name, node in sorted(self._nodes.items()):
+            busy = self._busy(name)
+            busy_total += busy
+            computers.append(
+                {
+                    'displayName': name,
+                    'offline': not node.online,
+                    'temporarilyOffline': False,
+                    'idle': busy == 0,
+                    'numExecutors': node.executors,
+                    'assignedLabels': [
+                        {
+                            'name': label
+                        } for label in node.labels.split() + [name]
+                    ],
+                    'executors': [
+                        {
+                            'idle': index >= busy
+                        } for index in range(node.executors)
+                    ],
+                }
+            )
+        return _json(
+            {
+                'busyExecutors': busy_total,
+                'totalExecutors': sum(
+                    node.executors for node in self._nodes.values()
+                    if node.online
+                ),
+                'computer': computers,
+            }
+        )
+
+    def _script(self, query, body):
+        script = parse_qs(body.decode('utf-8')).get('script', [''])[0]
+        specs = re.search(
+            r"new String\('([A-Za-z0-9+/=]+)'\.decodeBase64\(\)", script
+        )
+        if specs is not None:
+            return Response(200, self._provision_nodes(specs.group(1)))
+        if 'runtimeMXBean.startTime' in script:
+            return Response(200, '%d\n' % (self._started_at * 1000))
+        if 'launcher.credentialsId' in script:
+            return Response(200, self._node_launchers())
+        hooks = re.search(r"new URL\('([^']+)'\)", script)
+        if hooks is not None:
+            self._hooks_url = hooks.group(1)
+        return Response(200, '')
+
+    def _provision_nodes(self, encoded):
+        specs = json.loads(base64.b64decode(encoded).decode('utf-8'))
+        outcomes = {}
+        for name, spec in specs.items():
+            existing = self._nodes.get(name)
+            if existing is not None and existing.labels == spec['labels'] \
+                    and existing.executors == spec['executors'] and \
+                    existing.host == spec['host'] and \
+                    existing.credentials_id == spec['credentials_id']:
+                outcomes[name] = 'unchanged'
+                continue
+            outcomes[name] = 'created' if existing is None else 'updated'
+            self._nodes[name] = _Node(
+                name, spec['labels'], spec['executors'],
+                time.time() + self.node_online_delay, spec['host'],
+                spec['credentials_id']
+            )
+        return json.dumps(outcomes)
+
+    def _node_launchers(self):
+        return json.dumps(
+            dict(
+                (
+                    name, {
+                        'host': node.host,
+                        'credentials_id': node.credentials_id,
+                    }
+                ) for name, node in self._nodes.items() if name != 'master'
+            )
+        )
+
+    def _create_job(self, query, body):
+        name = query.get('name')
+        if name in self._jobs:
+            return Response(400, 'A job already exists with the name')
+        self._jobs[name] = _Job(name, body.decode('utf-8'))
+        return Response(200)
+
+    def _job_info(self, query, body, job):
+        if job not in self._jobs:
+            return Response(404)
+        if query.get('tree') == 'name':
+            return _json({'name': job})
+        builds = self._jobs[job].builds
+        return _json(
+            {
+                'name': job,
+                'nextBuildNumber': self._jobs[job].next_number,
+                'builds': [
+                    {
+                        'number': build.number
+                    } for build in reversed(builds)
+                ],
+                'lastBuild': {
+                    'number': builds[-1].number
+                } if builds else None,
+            }
+        )
+
+    def _job_config(self, query, body, job):
+        if job not in self._jobs:
+            return Response(404)
+        return Response(
+            200, self._jobs[job].config_xml, {'Content-Type': 'text/xml'}
+        )
+
+    def _reconfig_job(self, query, body, job):
+        if job not in self._jobs:
+            return Response(404)
+        self._jobs[job].configure(body.decode('utf-8'))
+        return Response(200)
+
+    def _build(self, query, body, job):
+        if job not in self._jobs:
+            return Response(404)
+        now = time.time()
+        item = _QueueItem(
+            self._next_queue_item, job, now, now + self.queue_delay
+        )
+        self._next_queue_item += 1
+        self._queue.append(item)
+        self._queue_items[item.number] = item
+        return Response(
+            201, '',
+            {'Location': '%squeue/item/%d/' % (self.url, item.number)}
+        )
+
+    def _get_build(self, job, number):
+        for build in self._jobs[job].builds if job in self._jobs else []:
+            if build.number == int(number):
+                return build
+        return None
+
+    def _build_info(self, query, body, job, number):
+        build = self._get_build(job, number)
+        if build is None:
+            return Response(404)
+        return _json(
+            {
+                'number': build.number,
+                'building': build.building,
+                'result': build.result,
+                'timestamp': int(build.started_at * 1000),
+                'duration': 0 if build.building else
+                int((build.finishes_at - build.started_at) * 1000),
+                'builtOn': build.node,
+            }
+        )
+
+    def _progressive_text(self, query, body, job, number):
+        build = self._get_build(job, number)
+        if build is None:
+            return Response(404)
+        start = int(query.get('start', 0))
+        headers = {'X-Text-Size': str(len(build.log))}
+        if build.building:
+            headers['X-More-Data'] = 'true'
+        return Response(200, build.log[start:], headers)
+
+    def _queue_item_json(self, item):
+        return {
+            'id': item.number,
+            'task': {
+                'name': item.job
+            },
+            'inQueueSince': int(item.queued_at * 1000),
+            'buildable': item.ready_at <= time.time(),
+            'cancelled': False,
+            'executable': {
+                'number': item.build.number
+            } if item.build else None,
+        }
+
+    def _list_queue(self, query, body):
+        return _json(
+            {'items': [self._queue_item_json(item) for item in self._queue]}
+        )
+
+    def _queue_item(self, query, body, number):
+        item = self._queue_items.get(int(number))
+        if item is None:
+            return Response(404)
+        return _json(self._queue_item_json(item))
+
+    def _list_credentials(self, query, body):
+        return _json(
+            {
+                'credentials': [
+                    {
+                        'id': _id
+                    } for _id in sorted(self._credentials)
+                ]
+            }
+        )
+
+    def _create_credentials(self, query, body):
+        form = parse_qs(body.decode('utf-8'))
+        credentials = json.loads(form['json'][0])['credentials']
+        self._credentials[credentials['id']] = credentials
+        return Response(200)
+
+    def _credential(self, query, body, id):
+        if id not in self._credentials:
+            return Response(404)
+        return _json(
+            {
+                'id': id,
+                'description': self._credentials[id].get('description'),
+            }
+        )
+
+    def _restart(self, query, body, kind):
+        if kind == 'reload':
+            # loading right away, the same instance comes back
+            self._down_until = time.time() + self.reload_delay
+            return Response(200)
+        # the new instance starts once the old one went down
+        now = time.time()
+        self._down_until = now + self.restart_delay
+        self._started_at = self._down_until
+        # downloads still running are killed along with the old instance
+        for name, done_at in self._installs:
+            if done_at <= now:
+                self._plugins[name] = True
+        self._installs = []
+        return Response(503, 'Jenkins is restarting')
@@ -0,0 +1,385 @@
+import collections
+import contextlib
+import copy
+import os
+import re
+import select
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import yaml
+
+try:
+    from lago.workdir import PrefixAlreadyExists
+except ImportError:
+    class PrefixAlreadyExists(Exception):
+        """
+        Stands in for Lago's when it isn't installed, FakeSDK.init raises
+        it for a prefix which already exists, like lago.sdk.init.
+        """
+
+import ssh_pool
+import testlib
+
+# Absolute paths in remote commands, except /dev/null, are resolved in
+# the VM's directory
+_ABSOLUTE_PATH = re.compile(r'''(^|[\s'"=])/(?!dev/null)''')
+
+
+def _rooted(root, command):
+    return _ABSOLUTE_PATH.sub(
+        lambda match: match.group(1) + root + '/', command
+    )
+
+
+class FakeChannel(object):
+    """
+    The parts of a paramiko Channel testlib and ssh_pool use, running the
+    command as a local shell in the VM's directory.
+    """
+
+    def __init__(self, vm):
+        self.vm = vm
+        self._proc = None
+        self._eof = False
+        self._err = []
+        self._err_done = False
+        self._err_cond = threading.Condition()
+        self._err_thread = None
+
+    def exec_command(self, command):
+        self._proc = subprocess.Popen(
+            ['sh', '-c', _rooted(self.vm.root, command)],
+            cwd=self.vm.root,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self._err_thread = threading.Thread(target=self._read_stderr)
+        self._err_thread.daemon = True
+        self._err_thread.start()
+
+    def _read_stderr(self):
+        for chunk in iter(lambda: os.read(self._proc.stderr.fileno(), 4096),
+                          b''):
+            with self._err_cond:
+                self._err.append(chunk)
+                self._err_cond.notify_all()
+        with self._err_cond:
+            self._err_done = True
+            self._err_cond.notify_all()
+
+    def fileno(self):
+        return self._proc.stdout.fileno()
+
+    def sendall(self, data):
+        self._proc.stdin.write(data)
+
+    def shutdown_write(self):
+        self._proc.stdin.close()
+
+    def makefile(self, mode='rb'):
+        return self._proc.stdout
+
+    def recv_ready(self):
+        return not self._eof and bool(select.select([self], [], [], 0)[0])
+
+    def recv(self, size):
+        data = os.read(self.fileno(), size)
+        if not data:
+            self._eof = True
+        return data
+
+    def recv_stderr_ready(self):
+        with self._err_cond:
+            return bool(self._err)
+
+    def recv_stderr(self, size):
+        # blocks until there's data, b'' once stderr was closed
+        with self._err_cond:
+            while not self._err and not self._err_done:
+                self._err_cond.wait()
+            data = b''.join(self._err)
+            self._err = [data[size:]] if data[size:] else []
+        return data[:size]
+
+    def exit_status_ready(self):
+        return self._proc.poll() is not None and \
+            not self._err_thread.is_alive()
+
+    def recv_exit_status(self):
+        code = self._proc.wait()
+        self._err_thread.join()
+        return code
+
+    def close(self):
+        if self._proc is None:
+            return
+        if not self._proc.stdin.closed:
+            self._proc.stdin.close()
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+        self._proc.stdout.close()
+
+
+class FakeSFTP(object):
+    def __init__(self, vm):
+        self.vm = vm
+
+    def get(self, remote_path, local_path):
+        shutil.copy(self.vm.path(remote_path), local_path)
+
+    def put(self, local_path, remote_path):
+        shutil.copy(local_path, self.vm.path(remote_path))
+
+    def close(self):
+        pass
+
+
+class FakeTransport(object):
+    def __init__(self, vm):
+        self.vm = vm
+        self.active = True
+
+    def is_active(self):
+        return self.active and self.vm.running
+
+    def open_session(self, timeout=None):
+        return FakeChannel(self.vm)
+
+
+class FakeSSHClient(object):
+    def __init__(self, vm):
+        self.vm = vm
+        self._transport = FakeTransport(vm)
+
+    def get_transport(self):
+        return self._transport
+
+    def open_sftp(self):
+        return FakeSFTP(self.vm)
+
+    def close(self):
+        self._transport.active = False
+
+
+class FakeVM(object):
+    """
+    A VM of a FakeEnv, defined by its domain spec in the init config and
+    backed by a local directory which stands for its file system.
+    """
+
+    def __init__(self, env, name, spec):
+        self.env = env
+        self._name = name
+        self._spec = spec
+        self.root = os.path.join(env.root, 'vms', name)
+        self.running = False
+        for path in ['var/tmp', 'var/log'] + [
+            artifact.lstrip('/') for artifact in spec.get('artifacts', [])
+        ]:
+            if not os.path.isdir(os.path.join(self.root, path)):
+                os.makedirs(os.path.join(self.root, path))
+
+    def name(self):
+        return self._name
+
+    def ip(self):
+        return '127.0.0.1'
+
+    @property
+    def metadata(self):
+        return self._spec.get('metadata', {})
+
+    @property
+    def groups(self):
+        return self._spec.get('groups', [])
+
+    def path(self, remote_path):
+        return os.path.join(self.root, remote_path.lstrip('/'))
+
+    def _artifact_paths(self):
+        return self._spec.get('artifacts', [])
+
+    def start(self):
+        time.sleep(self.env.sdk.boot_latency)
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def _get_ssh_client(self):
+        if not self.running:
+            raise RuntimeError('%s is not running' % self._name)
+        time.sleep(self.env.sdk.ssh_latency)
+        return FakeSSHClient(self)
+
+    def wait_for_ssh(self):
+        ssh_pool.get_ssh_pool().wait_for_ssh(self)
+
+    def ssh_reachable(self, tries=None, propagate_fail=False):
+        reachable = ssh_pool.get_ssh_pool().ssh_reachable(self, tries or 1)
+        if not reachable and propagate_fail:
+            raise RuntimeError('%s is not reachable through ssh' % self._name)
+        return reachable
+
+    def ssh(self, command, data=None, show_output=True, **kwargs):
+        return ssh_pool.get_ssh_pool().ssh(self, command, data)
+
+    def copy_from(self, remote_path, local_path, recursive=True, **kwargs):
+        source = self.path(remote_path)
+        if os.path.isdir(source):
+            shutil.copytree(source, local_path)
+        else:
+            shutil.copy(source, local_path)
+
+    def copy_to(self, local_path, remote_path, recursive=True, **kwargs):
+        destination = self.path(remote_path)
+        if os.path.isdir(local_path):
+            shutil.copytree(local_path, destination)
+        else:
+            shutil.copy(local_path, destination)
+
+    def collect_artifacts(self, host_path, ignore_nopath=False):
+        for artifact in self._artifact_paths():
+            if not os.path.exists(self.path(artifact)):
+                if ignore_nopath:
+                    continue
+                raise RuntimeError(
+                    '%s has no artifact %s' % (self._name, artifact)
+                )
+            self.copy_from(
+                artifact,
+                os.path.join(
+                    host_path, artifact.strip('/').replace('/', '_')
+                )
+            )
+
+
+class FakeEnv(object):
+    def __init__(self, sdk, root, config):
+        self.sdk = sdk
+        self.root = root
+        with open(config, mode='rt') as f:
+            spec = yaml.safe_load(f)
+        domains = spec.get('domains', {})
+        if sdk.slaves is not None:
+            domains = self._scale_slaves(domains, sdk.slaves)
+        self._vms = collections.OrderedDict(
+            (name, FakeVM(self, name, domains[name]))
+            for name in sorted(domains)
+        )
+        self._snapshots = collections.defaultdict(list)
+
+    @staticmethod
+    def _scale_slaves(domains, count):
+        slaves = sorted(
+            name for name, domain in domains.items()
+            if 'jenkins-slaves' in domain.get('groups', [])
+        )
+        scaled = dict(
+            (name, domain) for name, domain in domains.items()
+            if name not in slaves
+        )
+        for index in range(count):
+            # clones keep the labels of the original slaves, round robin
+            scaled['jenkins-slave-%d' % index] = copy.deepcopy(
+                domains[slaves[index % len(slaves)]]
+            )
+        return scaled
+
+    def get_vms(self):
+        return self._vms
+
+    def start(self):
+        vms = [vm for vm in self._vms.values() if not vm.running]
+        testlib.run_concurrently(
+            [vm.start for vm in vms], max_workers=max(len(vms), 1)
+        )
+
+    def stop(self):
+        for vm in self._vms.values():
+            vm.stop()
+
+    def destroy(self):
+        self.stop()
+        shutil.rmtree(self.root)
+
+    def get_snapshots(self):
+        return dict(
+            (name, list(self._snapshots[name])) for name in self._vms
+        )
+
+    def _snapshot_path(self, vm, name):
+        return os.path.join(self.root, 'snapshots', name, vm.name())
+
+    def create_snapshots(self, name):
+        for vm in self._vms.values():
+            shutil.copytree(vm.root, self._snapshot_path(vm, name))
+            self._snapshots[vm.name()].append(name)
+
+    def revert_snapshots(self, name):
+        for vm in self._vms.values():
+            shutil.rmtree(vm.root)
+            shutil.copytree(self._snapshot_path(vm, name), vm.root)
+
+    def collect_artifacts(self, output_dir, ignore_nopath=False):
+        for vm in self._vms.values():
+            path = os.path.join(output_dir, vm.name())
+            os.makedirs(path)
+            vm.collect_artifacts(path, ignore_nopath)
+
+    def ansible_inventory(self, keys=None):
+        groups = collections.defaultdict(list)
+        for vm in self._vms.values():
+            for group in vm.groups:
+                groups[group].append(vm)
+        return '\n'.join(
+            '[%s]\n%s\n' % (
+                group,
+                '\n'.join(
+                    '%s ansible_host=%s' % (vm.name(), vm.ip()) for vm in vms
+                )
+            ) for group, vms in sorted(groups.items())
+        )
+
+    @contextlib.contextmanager
+    def ansible_inventory_temp_file(self, keys=None):
+        with tempfile.NamedTemporaryFile(mode='w') as inventory:
+            inventory.write(self.ansible_inventory(keys))
+            inventory.flush()
+            yield inventory
+
+
+class FakeSDK(object):
+    """
+    Stands in for lago.sdk: init builds the VMs of the init config as
+    FakeVMs in a directory under 'root' instead of booting them. Every VM
+    takes 'boot_latency' seconds to start and every SSH handshake takes
+    'ssh_latency' seconds. With 'slaves' set, the slaves of the config are
+    cloned into that many.
+    """
+
+    def __init__(self, root, boot_latency=0, ssh_latency=0, slaves=None):
+        self.root = root
+        self.boot_latency = boot_latency
+        self.ssh_latency = ssh_latency
+        self.slaves = slaves
+        self._prefixes = set()
+        self._envs = {}
+
+    def init(self, config, workdir=None, prefix_name='default', **kwargs):
+        if (workdir, prefix_name) in self._prefixes:
+            raise PrefixAlreadyExists()
+
+        root = tempfile.mkdtemp(prefix=prefix_name + '-', dir=self.root)
+        self._prefixes.add((workdir, prefix_name))
+        self._envs[workdir] = FakeEnv(self, root, config)
+        return self._envs[workdir]
+
+    def load_env(self, workdir, **kwargs):
+        return self._envs[workdir]
@@ -0,0 +1,332 @@
+import collections
+import functools
+import json
+import re
+import threading
+import time
+
+import jenkins
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request
+
+CRUMB_PATH = 'crumbIssuer/api/json'
+QUEUE_ITEM_PATH = 'queue/item/%(number)s/api/json?depth=%(depth)s'
+
+# Callables called as hook(method, url, status, start, duration) after
+# every request a PooledJenkins sends, status is None if it failed
+_request_hooks = []
+
+
+def add_request_hook(hook):
+    _request_hooks.append(hook)
+
+
+def remove_request_hook(hook):
+    _request_hooks.remove(hook)
+
+
+class PooledJenkins(jenkins.Jenkins):
+    """
+    A jenkins.Jenkins client which sends every request, including the raw
+    ones built by testlib, through a keep-alive connection pool.
+    The crumb is fetched once per session and at most 'max_concurrency'
+    requests are in flight at any given time.
+    """
+
+    def __init__(
+        self,
+        url,
+        username=None,
+        password=None,
+        timeout=30,
+        pool_size=10,
+        max_concurrency=10,
+    ):
+        super(PooledJenkins, self).__init__(url, username, password)
+        self.request_timeout = timeout
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        if username is not None:
+            self._session.auth = (username, password)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._crumb_lock = threading.Lock()
+        self._crumb = None
+
+    def close(self):
+        self._session.close()
+
+    def reset_session(self):
+        # Jenkins ties crumbs to the HTTP session, a restart drops both
+        with self._crumb_lock:
+            self._crumb = None
+            self._session.cookies.clear()
+
+    def _get_crumb(self):
+        with self._crumb_lock:
+            if self._crumb is None:
+                try:
+                    response = self.jenkins_open(
+                        Request(self._build_url(CRUMB_PATH)), add_crumb=False
+                    )
+                except jenkins.NotFoundException:
+                    self._crumb = {}
+                else:
+                    crumb = json.loads(response)
+                    self._crumb = {
+                        crumb['crumbRequestField']: crumb['crumb']
+                    }
+            return self._crumb
+
+    def maybe_add_crumb(self, req):
+        for header, value in self._get_crumb().items():
+            req.add_header(header, value)
+
+    def _send(self, req, add_crumb, stream=False):
+        headers = dict(req.header_items())
+        method = req.get_method()
+        if add_crumb and method != 'GET':
+            headers.update(self._get_crumb())
+        data = req.data if hasattr(req, 'data') else req.get_data()
+
+        with self._slots:
+            start = time.time()
+            response = None
+            try:
+                response = self._session.request(
+                    method,
+                    req.get_full_url(),
+                    data=data,
+                    headers=headers,
+                    timeout=self.request_timeout,
+                    stream=stream,
+                )
+            finally:
+                for hook in _request_hooks:
+                    hook(
+                        method, req.get_full_url(),
+                        response.status_code if response is not None else
+                        None, start, time.time() - start
+                    )
+
+            return response
+
+    def get_version(self):
+        request = Request(self._build_url(''))
+        request.add_header('X-Jenkins', '0.0')
+        try:
+            response = self._send(request, add_crumb=False)
+        except requests.RequestException:
+            response = None
+        if response is None or response.status_code >= 400:
+            raise jenkins.BadHTTPException(
+                'Error communicating with server[%s]' % self.server
+            )
+
+        return response.headers.get('X-Jenkins')
+
+    def jenkins_request(self, req, add_crumb=True, stream=False):
+        try:
+            response = self._send(req, add_crumb, stream)
+            if response.status_code == 403 and add_crumb and self._crumb:
+                # The crumb expired together with the session, get a new one
+                self.reset_session()
+                response = self._send(req, add_crumb, stream)
+        except requests.Timeout as e:
+            raise jenkins.TimeoutException('Error in request: %s' % e)
+        except requests.ConnectionError as e:
+            raise jenkins.JenkinsException('Error in request: %s' % e)
+
+        code = response.status_code
+        if code in [401, 403, 500]:
+            raise jenkins.JenkinsException(
+                'Error in request. Possibly authentication failed [%s]: %s' %
+                (code, response.reason)
+            )
+        elif code == 404:
+            raise jenkins.NotFoundException(
+                'Requested item could not be found'
+            )
+        elif code >= 400:
+            raise HTTPError(
+                req.get_full_url(), code, response.reason, response.headers,
+                None
+            )
+
+        return response
+
+    def jenkins_open(self, req, add_crumb=True):
+        return self.jenkins_request(req, add_crumb).content.decode('utf-8')
+
+    def build_job(self, name, parameters=None, token=None):
+        """
+        Unlike jenkins.Jenkins.build_job, returns the id of the queue item
+        Jenkins created for the build, or None if it didn't report one.
+        """
+        response = self.jenkins_request(
+            Request(self.build_job_url(name, parameters, token), b'')
+        )
+        match = re.search(
+            r'/queue/item/(\d+)', response.headers.get('Location', '')
+        )
+
+        return int(match.group(1)) if match else None
+
+    def get_queue_item(self, number, depth=0):
+        url = self._build_url(
+            QUEUE_ITEM_PATH, {'number': number,
+                              'depth': depth}
+        )
+        return json.loads(self.jenkins_open(Request(url)))
+
+
+# (path pattern, seconds) pairs, the first matching pattern decides how long
+# a GET response is cached. Only what changes through the client's own
+# writes, which invalidate it, is cached: the user, plugins, credentials,
+# job existence and job configs. The version, nodes, builds and queue are
+# never cached since the waits poll them for changes the client didn't make.
+CACHE_TTLS = [
+    (r'^me/api/json', 300),
+    (r'^pluginManager/api/json', 300),
+    (r'^credentials/store/', 60),
+    (r'^job/[^/]+/api/json\?tree=name$', 60),
+    (r'^job/[^/]+/config\.xml$', 60),
+]
+
+# A write to a path in one of these groups drops the cached entries of the
+# same group, a write to any other path drops the whole cache.
+CACHE_GROUPS = [
+    (r'^(job/|createItem)', 'jobs'),
+    (r'^computer/', 'nodes'),
+    (r'^credentials/', 'credentials'),
+    (r'^pluginManager/', 'plugins'),
+    (r'^me/', 'users'),
+    # provisions nodes, credentials and event hooks, none of them cached
+    (r'^scriptText$', 'scripts'),
+]
+
+
+class _CacheEntry(object):
+    def __init__(self, group, expires, response=None, exception=None):
+        self.group = group
+        self.expires = expires
+        self.response = response
+        self.exception = exception
+
+
+class CachingJenkins(PooledJenkins):
+    """
+    A PooledJenkins which serves what only changes through writes, see
+    CACHE_TTLS, from a TTL and LRU bounded cache. Writes issued through
+    the client invalidate the entries they may have changed.
+    """
+
+    def __init__(self, url, username=None, password=None, cache_size=256,
+                 ttls=None, **kwargs):
+        super(CachingJenkins, self).__init__(
+            url, username, password, **kwargs
+        )
+        self.cache_size = cache_size
+        self._ttls = [
+            (re.compile(pattern), ttl)
+            for pattern, ttl in (CACHE_TTLS if ttls is None else ttls)
+        ]
+        self._groups = [
+            (re.compile(pattern), group) for pattern, group in CACHE_GROUPS
+        ]
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def cache_stats(self):
+        with self._cache_lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._cache)
+        return stats
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+    def reset_session(self):
+        super(CachingJenkins, self).reset_session()
+        self.clear_cache()
+
+    def _path(self, url):
+        return url[len(self.server):] if url.startswith(self.server) else url
+
+    def _ttl(self, path):
+        for pattern, ttl in self._ttls:
+            if pattern.match(path):
+                return ttl
+        return None
+
+    def _group(self, path):
+        for pattern, group in self._groups:
+            if pattern.match(path):
+                return group
+        return None
+
+    def invalidate(self, path):
+        group = self._group(path)
+        with self._cache_lock:
+            stale = [
+                key for key, entry in self._cache.items()
+                if group is None or entry.group == group
+            ]
+            for key in stale:
+                del self._cache[key]
+            self._stats['invalidations'] += len(stale)
+
+    def _cached(self, url, fetch):
+        path = self._path(url)
+        ttl = self._ttl(path)
+        if ttl is None:
+            return fetch()
+
+        now = time.time()
+        with self._cache_lock:
+            entry = self._cache.get(url)
+            if entry is not None and entry.expires > now:
+                self._cache[url] = self._cache.pop(url)
+                self._stats['hits'] += 1
+                if entry.exception is not None:
+                    raise entry.exception
+                return entry.response
+            self._stats['misses'] += 1
+
+        entry = _CacheEntry(self._group(path), now + ttl)
+        try:
+            entry.response = fetch()
+        except jenkins.NotFoundException as e:
+            entry.exception = e
+        with self._cache_lock:
+            self._cache[url] = entry
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+                self._stats['evictions'] += 1
+        if entry.exception is not None:
+            raise entry.exception
+
+        return entry.response
+
+    def jenkins_request(self, req, add_crumb=True, stream=False):
+        try:
+            return super(CachingJenkins, self).jenkins_request(
+                req, add_crumb, stream
+            )
+        finally:
+            if req.get_method() != 'GET':
+                self.invalidate(self._path(req.get_full_url()))
+
+    def jenkins_open(self, req, add_crumb=True):
+        fetch = functools.partial(
+            super(CachingJenkins, self).jenkins_open, req, add_crumb
+        )
+        if req.get_method() != 'GET':
+            return fetch()
+
+        return self._cached(req.get_full_url(), fetch)
@@ -0,0 +1,111 @@
+import copy
+import threading
+import xml.etree.ElementTree as ET
+
+import reconciler
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def _element(root, path):
+    element = root
+    for tag in path.split('/'):
+        child = element.find(tag)
+        if child is None:
+            child = ET.SubElement(element, tag)
+        element = child
+    return element
+
+
+class JobTemplate(object):
+    """
+    A parsed job config.xml which renders variants of itself without
+    parsing it again. Rendered variants are cached as well.
+    """
+
+    def __init__(self, config_xml):
+        if not isinstance(config_xml, bytes):
+            config_xml = config_xml.encode('utf-8')
+        self._root = ET.fromstring(config_xml)
+        self._rendered = {}
+        self._lock = threading.Lock()
+
+    def render(
+        self,
+        label=None,
+        command=None,
+        concurrent=None,
+        builds_to_keep=None,
+        artifacts_to_keep=None,
+    ):
+        key = (label, command, concurrent, builds_to_keep, artifacts_to_keep)
+        with self._lock:
+            if key in self._rendered:
+                return self._rendered[key]
+
+        root = copy.deepcopy(self._root)
+        if label is not None:
+            _element(root, 'assignedNode').text = label
+            _element(root, 'canRoam').text = 'false'
+        if command is not None:
+            _element(root, 'builders/hudson.tasks.Shell/command').text = \
+                command
+        if concurrent is not None:
+            _element(root, 'concurrentBuild').text = str(bool(concurrent)
+                                                         ).lower()
+        if builds_to_keep is not None or artifacts_to_keep is not None:
+            strategy = _element(
+                root,
+                'properties/jenkins.model.BuildDiscarderProperty/strategy'
+            )
+            strategy.set('class', 'hudson.tasks.LogRotator')
+            for tag, value in [
+                ('daysToKeep', None),
+                ('numToKeep', builds_to_keep),
+                ('artifactDaysToKeep', None),
+                ('artifactNumToKeep', artifacts_to_keep),
+            ]:
+                element = _element(strategy, tag)
+                if value is not None or element.text is None:
+                    element.text = str(-1 if value is None else value)
+
+        config_xml = ET.tostring(root).decode('utf-8')
+        with self._lock:
+            self._rendered[key] = config_xml
+        return config_xml
+
+
+def load_template(path):
+    """
+    Returns the JobTemplate of the config.xml at 'path', which is read
+    and parsed only the first time it is requested.
+    """
+    with _templates_lock:
+        if path not in _templates:
+            with open(path, mode='rb') as f:
+                _templates[path] = JobTemplate(f.read())
+        return _templates[path]
+
+
+class JobFactory(object):
+    """
+    Collects rendered jobs and creates or updates all of them at once,
+    with at most 'max_workers' concurrent requests. Jobs whose config
+    already matches the server's are left untouched.
+    """
+
+    def __init__(self, jenkins_api, max_workers=10):
+        self.jenkins_api = jenkins_api
+        self.max_workers = max_workers
+        self.jobs = {}
+
+    def add(self, name, template, **variant):
+        if not isinstance(template, JobTemplate):
+            template = load_template(template)
+        self.jobs[name] = template.render(**variant)
+
+    def apply(self):
+        return reconciler.reconcile(
+            self.jenkins_api, {'jobs': self.jobs}, self.max_workers
+        )
@@ -0,0 +1,223 @@
+import collections
+import json
+import math
+import threading
+
+import jenkins
+from six.moves.urllib.request import Request
+
+import testlib
+
+EXECUTORS_TREE = (
+    'busyExecutors,totalExecutors,'
+    'computer[displayName,offline,numExecutors,executors[idle]]'
+)
+PERCENTILES = [50, 90, 95, 99]
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of 'values', None if there are none.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+def distribution(values):
+    values = [value for value in values if value is not None]
+    summary = dict(
+        ('p%s' % p, percentile(values, p)) for p in PERCENTILES
+    )
+    summary['max'] = max(values) if values else None
+    summary['count'] = len(values)
+
+    return summary
+
+
+def sample_executors(jenkins_api):
+    """
+    Returns a dict with the busy and total executors of the cluster and
+    the number of busy executors of every online node.
+    """
+    url = jenkins_api._build_url(
+        'computer/api/json?tree=%(tree)s', {'tree': EXECUTORS_TREE}
+    )
+    computers = json.loads(jenkins_api.jenkins_open(Request(url)))
+
+    return {
+        'busy': computers['busyExecutors'],
+        'total': computers['totalExecutors'],
+        'nodes': dict(
+            (
+                computer['displayName'],
+                sum(
+                    1 for executor in computer['executors']
+                    if not executor['idle']
+                )
+            ) for computer in computers['computer'] if not computer['offline']
+        ),
+    }
+
+
+class LoadReport(object):
+    def __init__(self, builds, jobs, samples, started_at, triggered_at,
+                 finished_at, bucket, errors=None):
+        self.builds = builds
+        self.errors = errors or []
+        self.jobs = jobs
+        self.samples = samples
+        self.started_at = started_at
+        self.triggered_at = triggered_at
+        self.finished_at = finished_at
+        self.bucket = bucket
+
+    def throughput(self):
+        """
+        Number of builds finished in every 'bucket' seconds since the load
+        started.
+        """
+        buckets = collections.Counter(
+            int((build.finished_at - self.started_at) // self.bucket)
+            for build in self.builds if build.finished_at is not None
+        )
+        return [
+            (index * self.bucket, buckets[index])
+            for index in range(max(buckets) + 1 if buckets else 0)
+        ]
+
+    def per_label(self):
+        """
+        label -> node -> number of builds of that label it ran.
+        """
+        labels = collections.defaultdict(collections.Counter)
+        for build in self.builds:
+            labels[self.jobs[build.job]][build.built_on] += 1
+        return dict(
+            (label, dict(nodes)) for label, nodes in labels.items()
+        )
+
+    def utilization(self):
+        ratios = [
+            float(sample['busy']) / sample['total']
+            for sample in self.samples if sample['total']
+        ]
+        return {
+            'mean': sum(ratios) / len(ratios) if ratios else None,
+            'peak': max(ratios) if ratios else None,
+            'samples': self.samples,
+        }
+
+    def summary(self):
+        elapsed = self.finished_at - self.started_at
+        finished = [build for build in self.builds if build.finished]
+        return {
+            'builds': len(self.builds),
+            'finished': len(finished),
+            'failed': sum(
+                1 for build in finished if build.result != 'SUCCESS'
+            ),
+            'elapsed': elapsed,
+            'trigger_rate': len(self.builds) /
+            (self.triggered_at - self.started_at or 1),
+            'builds_per_second': len(finished) / (elapsed or 1),
+            'queue_wait': distribution(
+                build.queue_wait for build in self.builds
+            ),
+            'start_latency': distribution(
+                build.start_latency for build in self.builds
+            ),
+            'duration': distribution(
+                build.duration for build in self.builds
+            ),
+            'throughput': self.throughput(),
+            'per_label': self.per_label(),
+            'utilization': self.utilization(),
+            'poll_errors': self.errors,
+        }
+
+    def write(self, path):
+        with open(path, mode='wt') as f:
+            json.dump(self.summary(), f, indent=4, sort_keys=True)
+
+
+class LoadGenerator(object):
+    """
+    Triggers 'builds' builds round robin over 'jobs' (job name -> label)
+    at a target 'rate' of builds per second and follows all of them with
+    a single BuildTracker, while a background thread samples the executor
+    utilization every 'sample_interval' seconds.
+    Polls which fail while triggering, e.g. for a queue item Jenkins
+    already dropped, are recorded in 'errors' and retried later.
+    """
+
+    def __init__(self, jenkins_api, jobs, builds, rate, events=None,
+                 console=None, sample_interval=1, bucket=10):
+        self.jenkins_api = jenkins_api
+        self.jobs = jobs
+        self.builds = builds
+        self.rate = float(rate)
+        self.sample_interval = sample_interval
+        self.bucket = bucket
+        self.tracker = testlib.BuildTracker(
+            jenkins_api, events=events, console=console
+        )
+        self.samples = []
+        self.errors = []
+        self._stop = threading.Event()
+
+    def _sample(self, started_at):
+        while not self._stop.is_set():
+            try:
+                sample = sample_executors(self.jenkins_api)
+            except (jenkins.JenkinsException, ValueError):
+                # a missed sample only lowers the resolution
+                pass
+            else:
+                sample['time'] = testlib.get_wait_engine().clock() - \
+                    started_at
+                self.samples.append(sample)
+            self._stop.wait(self.sample_interval)
+
+    def _trigger(self, started_at):
+        engine = testlib.get_wait_engine()
+        names = sorted(self.jobs)
+        last_poll = started_at
+        for index in range(self.builds):
+            due = started_at + index / self.rate
+            now = engine.clock()
+            # Resolve queue items while ahead of schedule, Jenkins forgets
+            # them a few minutes after they leave the queue
+            if due - now > 0 and now - last_poll > self.sample_interval:
+                try:
+                    self.tracker.poll('started')
+                except jenkins.JenkinsException as e:
+                    self.errors.append(str(e))
+                last_poll = now = engine.clock()
+            if due > now:
+                engine.sleep(due - now)
+            self.tracker.trigger(names[index % len(names)])
+
+    def run(self, timeout=testlib.LONG_TIMEOUT):
+        """
+        Returns a LoadReport once all the builds finished, raises if they
+        didn't within 'timeout' seconds of the last trigger.
+        """
+        engine = testlib.get_wait_engine()
+        started_at = engine.clock()
+        sampler = threading.Thread(target=self._sample, args=(started_at, ))
+        sampler.daemon = True
+        sampler.start()
+        try:
+            self._trigger(started_at)
+            triggered_at = engine.clock()
+            self.tracker.wait(timeout)
+        finally:
+            self._stop.set()
+            sampler.join()
+
+        return LoadReport(
+            self.tracker.builds, self.jobs, self.samples, started_at,
+            triggered_at, engine.clock(), self.bucket, self.errors
+        )
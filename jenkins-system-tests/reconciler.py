@@ -0,0 +1,374 @@
+import base64
+import functools
+import hashlib
+import json
+import xml.etree.ElementTree as ET
+
+from six.moves.urllib.request import Request
+
+import testlib
+
+CREDENTIALS_TREE = (
+    'credentials/store/system/domain/_/api/json?tree=credentials[id]'
+)
+JOBS_TREE = 'api/json?tree=jobs[name]'
+PLUGINS_TREE = 'pluginManager/api/json?tree=plugins[shortName,active]'
+INSTALL_PLUGINS = 'pluginManager/installNecessaryPlugins'
+UPDATE_CENTER_TREE = (
+    'updateCenter/api/json?tree=jobs[type,name,status[type,success]]'
+)
+# states of update center jobs which haven't finished downloading
+INSTALLING = ('Pending', 'Installing')
+
+
+PROVISION_NODES_SCRIPT = '''
+import groovy.json.JsonOutput
+import groovy.json.JsonSlurper
+import hudson.model.Node
+import hudson.plugins.sshslaves.SSHLauncher
+import hudson.slaves.DumbSlave
+import hudson.slaves.RetentionStrategy
+import jenkins.model.Jenkins
+
+def specs = new JsonSlurper().parseText(
+    new String('%(specs)s'.decodeBase64(), 'UTF-8')
+)
+
+def launcher(spec) {
+    try {
+        return new SSHLauncher(spec.host, 22, spec.credentials_id)
+    } catch (GroovyRuntimeException e) {
+        // ssh-slaves releases before 1.30 lack the short constructor
+        return new SSHLauncher(
+            spec.host, 22, spec.credentials_id, null, null, null, null,
+            null, null, null
+        )
+    }
+}
+
+def outcomes = [:]
+specs.each { name, spec ->
+    try {
+        def existing = Jenkins.instance.getNode(name)
+        def node = new DumbSlave(
+            name, spec.description, '/var/lib/jenkins',
+            spec.executors.toString(),
+            spec.exclusive ? Node.Mode.EXCLUSIVE : Node.Mode.NORMAL,
+            spec.labels, launcher(spec), new RetentionStrategy.Always(), []
+        )
+        if (existing == null) {
+            Jenkins.instance.addNode(node)
+            outcomes[name] = 'created'
+        } else if (existing.labelString == spec.labels &&
+                   existing.numExecutors == spec.executors &&
+                   existing.launcher?.host == spec.host &&
+                   existing.launcher?.credentialsId == spec.credentials_id) {
+            outcomes[name] = 'unchanged'
+        } else {
+            Jenkins.instance.addNode(node)
+            outcomes[name] = 'updated'
+        }
+    } catch (Exception e) {
+        outcomes[name] = 'error: ' + e.toString()
+    }
+}
+print(JsonOutput.toJson(outcomes))
+'''
+
+NODE_LAUNCHERS_SCRIPT = '''
+import groovy.json.JsonOutput
+import jenkins.model.Jenkins
+
+def launchers = [:]
+Jenkins.instance.nodes.each { node ->
+    def launcher = node.launcher
+    launchers[node.nodeName] = [
+        host: launcher?.hasProperty('host') ? launcher.host : null,
+        credentials_id: launcher?.hasProperty('credentialsId') ?
+            launcher.credentialsId : null,
+    ]
+}
+print(JsonOutput.toJson(launchers))
+'''
+
+
+def ssh_node(host, credentials_id, labels='', executors=1,
+             description='test slave', exclusive=True):
+    return {
+        'host': host,
+        'credentials_id': credentials_id,
+        'labels': labels or '',
+        'executors': executors,
+        'description': description,
+        'exclusive': exclusive,
+    }
+
+
+def _canonical(element):
+    # Jenkins stamps elements with the version of the plugin providing them
+    attrs = sorted(
+        (k, v) for k, v in element.attrib.items() if k != 'plugin'
+    )
+    return '<%s %s>%s%s</%s>' % (
+        element.tag, attrs, (element.text or '').strip(),
+        ''.join(_canonical(child) for child in element), element.tag
+    )
+
+
+def config_hash(config_xml):
+    """
+    Hash of a job's config.xml which ignores formatting, the XML
+    declaration and plugin versions, so a config read back from Jenkins
+    matches the one it was created from.
+    """
+    if not isinstance(config_xml, bytes):
+        config_xml = config_xml.encode('utf-8')
+    canonical = _canonical(ET.fromstring(config_xml))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class Change(object):
+    def __init__(self, kind, name, action, apply):
+        self.kind = kind
+        self.name = name
+        self.action = action
+        self.apply = apply
+
+    def __repr__(self):
+        return '<%s %s %s>' % (self.action, self.kind, self.name)
+
+
+class Reconciler(object):
+    """
+    Brings Jenkins to a desired state, a dict with any of the keys:
+
+    - 'plugins': list of plugin short names
+    - 'credentials': credentials id -> dict of username, password and
+      description
+    - 'jobs': job name -> config.xml
+    - 'nodes': node name -> spec, as returned by ssh_node, all the nodes
+      which differ are provisioned by a single provision_nodes request
+
+    The current state is read with one bulk request per kind, plus one
+    for the launchers of the nodes, and only the differences are applied.
+    Changes of the same kind are applied concurrently, kinds are applied
+    in the order above since nodes depend on credentials and plugins.
+    Unless 'restart' is off, installed plugins are activated by restarting
+    Jenkins once they're downloaded.
+    """
+
+    def __init__(self, jenkins_api, max_workers=10, restart=True):
+        self.jenkins_api = jenkins_api
+        self.max_workers = max_workers
+        self.restart = restart
+
+    def _get_json(self, path):
+        return json.loads(
+            self.jenkins_api.jenkins_open(
+                Request(self.jenkins_api._build_url(path))
+            )
+        )
+
+    def _plan_plugins(self, plugins):
+        active = set(
+            plugin['shortName']
+            for plugin in self._get_json(PLUGINS_TREE)['plugins']
+            if plugin['active']
+        )
+        missing = sorted(set(plugins) - active)
+        if not missing:
+            return []
+
+        return [
+            Change(
+                'plugins', ', '.join(missing), 'install',
+                functools.partial(self._install_plugins, missing)
+            )
+        ]
+
+    def _install_plugins(self, plugins):
+        payload = '<jenkins>%s</jenkins>' % ''.join(
+            '<install plugin="%s@latest" />' % plugin for plugin in plugins
+        )
+        self.jenkins_api.jenkins_open(
+            Request(
+                self.jenkins_api._build_url(INSTALL_PLUGINS),
+                payload.encode('utf-8'), {'Content-Type': 'text/xml'}
+            )
+        )
+
+    def _installs_done(self):
+        return not [
+            job for job in self._get_json(UPDATE_CENTER_TREE)['jobs']
+            if (job.get('status') or {}).get('type') in INSTALLING
+        ]
+
+    def _activate_plugins(self, plugins):
+        # installNecessaryPlugins only schedules the downloads, restarting
+        # while they run would kill them
+        testlib.assert_true_within_long(self._installs_done)
+        testlib.restart_jenkins_and_wait(self.jenkins_api)
+        missing = self._plan_plugins(plugins)
+        if missing:
+            raise RuntimeError(
+                'plugins not active after the restart: %s' % missing[0].name
+            )
+
+    def _plan_credentials(self, credentials):
+        existing = set(
+            cred['id']
+            for cred in self._get_json(CREDENTIALS_TREE)['credentials']
+        )
+        return [
+            Change(
+                'credentials', _uuid, 'create',
+                functools.partial(
+                    testlib.add_credentials_on_jenkins, self.jenkins_api,
+                    _uuid, **spec
+                )
+            ) for _uuid, spec in sorted(credentials.items())
+            if _uuid not in existing
+        ]
+
+    def _plan_jobs(self, jobs):
+        existing = set(
+            job['name'] for job in self._get_json(JOBS_TREE)['jobs']
+        )
+        names = sorted(name for name in jobs if name in existing)
+        current = dict(
+            zip(
+                names,
+                testlib.run_concurrently(
+                    [
+                        functools.partial(
+                            self.jenkins_api.get_job_config, name
+                        ) for name in names
+                    ], self.max_workers
+                )
+            )
+        )
+
+        changes = []
+        for name, config_xml in sorted(jobs.items()):
+            if name not in existing:
+                changes.append(
+                    Change(
+                        'jobs', name, 'create',
+                        functools.partial(
+                            self.jenkins_api.create_job, name, config_xml
+                        )
+                    )
+                )
+            elif config_hash(current[name]) != config_hash(config_xml):
+                changes.append(
+                    Change(
+                        'jobs', name, 'update',
+                        functools.partial(
+                            self.jenkins_api.reconfig_job, name, config_xml
+                        )
+                    )
+                )
+        return changes
+
+    def _plan_nodes(self, nodes):
+        # a node without labels may come with None for them
+        nodes = dict(
+            (name, dict(spec, labels=spec.get('labels') or ''))
+            for name, spec in nodes.items()
+        )
+        snapshot = testlib.get_nodes(self.jenkins_api)
+        # the computers API doesn't tell how Jenkins connects to a node
+        launchers = json.loads(
+            self.jenkins_api.run_script(NODE_LAUNCHERS_SCRIPT)
+        )
+        stale = dict(
+            (name, spec) for name, spec in nodes.items()
+            if name not in snapshot or
+            set(snapshot.labels(name)) != set(spec['labels'].split()) or
+            snapshot[name]['numExecutors'] != spec['executors'] or
+            launchers.get(name) != {
+                'host': spec['host'],
+                'credentials_id': spec['credentials_id'],
+            }
+        )
+        if not stale:
+            return []
+
+        # all the nodes are provisioned in a single request
+        return [
+            Change(
+                'nodes', ', '.join(sorted(stale)), 'provision',
+                functools.partial(provision_nodes, self.jenkins_api, stale)
+            )
+        ]
+
+    def plan(self, desired):
+        planners = [
+            ('plugins', self._plan_plugins),
+            ('credentials', self._plan_credentials),
+            ('jobs', self._plan_jobs),
+            ('nodes', self._plan_nodes),
+        ]
+        return [
+            planner(desired[kind]) for kind, planner in planners
+            if desired.get(kind)
+        ]
+
+    def apply(self, desired):
+        """
+        Returns the list of applied changes.
+        """
+        applied = []
+        for changes in self.plan(desired):
+            testlib.run_concurrently(
+                [change.apply for change in changes], self.max_workers
+            )
+            applied.extend(changes)
+            if changes and changes[0].kind == 'plugins' and self.restart:
+                self._activate_plugins(desired['plugins'])
+
+        return applied
+
+
+def reconcile(jenkins_api, desired, max_workers=10):
+    return Reconciler(jenkins_api, max_workers).apply(desired)
+
+
+def ssh_nodes_from_env(env, credentials_id, group='jenkins-slaves'):
+    """
+    Node specs for all the VMs in 'group', labeled by their
+    'jenkins-label' metadata and with 'jenkins-executors' executors.
+    """
+    return dict(
+        (
+            vm.name(),
+            ssh_node(
+                vm.name(),
+                credentials_id,
+                labels=vm.metadata.get('jenkins-label', ''),
+                executors=int(vm.metadata.get('jenkins-executors', 1)),
+            )
+        ) for vm in env.get_vms().values() if group in vm.groups
+    )
+
+
+def provision_nodes(jenkins_api, nodes):
+    """
+    Create or update all of 'nodes' (name -> ssh_node spec) with a single
+    script console request. Returns a dict of name -> 'created',
+    'updated' or 'unchanged', raises if any of the nodes failed.
+    """
+    specs = base64.b64encode(json.dumps(nodes).encode('utf-8'))
+    outcomes = json.loads(
+        jenkins_api.run_script(
+            PROVISION_NODES_SCRIPT % {'specs': specs.decode('ascii')}
+        )
+    )
+    failed = dict(
+        (name, outcome) for name, outcome in outcomes.items()
+        if outcome.startswith('error')
+    )
+    if failed:
+        raise RuntimeError('provisioning nodes failed: %s' % failed)
+
+    return outcomes
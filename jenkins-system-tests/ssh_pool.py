@@ -0,0 +1,259 @@
+import collections
+import contextlib
+import select
+import socket
+import threading
+import time
+
+CommandStatus = collections.namedtuple(
+    'CommandStatus', ['code', 'out', 'err']
+)
+
+# Errors which mean the session is gone, the VM may still be reachable
+SESSION_ERRORS = (socket.error, EOFError)
+# Errors of a connection attempt to a VM which may not be up yet
+CONNECT_ERRORS = SESSION_ERRORS
+
+try:
+    import paramiko
+    from lago import utils
+except ImportError:
+    # without Lago the pool only serves VM like objects, e.g. fake_lago's
+    pass
+else:
+    SESSION_ERRORS += (paramiko.SSHException, )
+    CONNECT_ERRORS = SESSION_ERRORS + (utils.LagoException, )
+
+
+class _Session(object):
+    def __init__(self, client, now):
+        self.client = client
+        self.last_used = now
+        self.last_checked = now
+        self.users = 0
+        self.discarded = False
+        self.lock = threading.Lock()
+
+
+class SSHPool(object):
+    """
+    Keeps one authenticated SSH session per VM alive across tests. Exec,
+    SFTP and streaming channels are multiplexed over the session's single
+    transport, so only the first use of a VM pays for the handshake.
+    A session that wasn't checked for 'health_interval' seconds is probed
+    with a channel round trip before it's handed out, and sessions idle
+    for more than 'idle_timeout' seconds are closed.
+    """
+
+    def __init__(self, idle_timeout=300, health_interval=10, clock=time.time):
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.clock = clock
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def _session(self, vm, use=False):
+        # Users are counted in the same critical section the session is
+        # looked up in, so it can't be evicted before it's used
+        with self._lock:
+            session = self._sessions.get(vm.name())
+            if session is None:
+                session = self._sessions[vm.name()] = _Session(
+                    None, self.clock()
+                )
+            if use:
+                session.users += 1
+            return session
+
+    def _healthy(self, session, now):
+        transport = session.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        if now - session.last_checked < self.health_interval:
+            return True
+        try:
+            transport.open_session(timeout=5).close()
+        except SESSION_ERRORS:
+            return False
+        session.last_checked = now
+        return True
+
+    def _connect(self, session, vm):
+        # Concurrent users of the same VM wait for a single handshake
+        with session.lock:
+            now = self.clock()
+            if session.client is not None and self._healthy(session, now):
+                self.stats['reused'] += 1
+            else:
+                if session.client is not None:
+                    session.client.close()
+                    self.stats['unhealthy'] += 1
+                session.client = None
+                session.client = vm._get_ssh_client()
+                session.last_checked = now
+                self.stats['connected'] += 1
+            session.last_used = now
+            return session.client
+
+    def client(self, vm):
+        """
+        Returns a connected paramiko client for 'vm', shared with all the
+        other users of the pool. Don't close it, use discard instead.
+        """
+        self.evict_idle()
+        return self._connect(self._session(vm), vm)
+
+    def discard(self, vm):
+        """
+        Closes the session of 'vm', e.g. after its snapshot was reverted.
+        A session which is in use is closed once its last user is done,
+        new users get a new session right away.
+        """
+        with self._lock:
+            session = self._sessions.pop(vm.name(), None)
+            if session is None:
+                return
+            session.discarded = True
+            close = not session.users
+        if close and session.client is not None:
+            session.client.close()
+
+    def evict_idle(self):
+        now = self.clock()
+        with self._lock:
+            idle = [
+                name for name, session in self._sessions.items()
+                if now - session.last_used > self.idle_timeout and
+                not session.users and not session.lock.locked()
+            ]
+            sessions = [self._sessions.pop(name) for name in idle]
+        for session in sessions:
+            if session.client is not None:
+                session.client.close()
+            self.stats['evicted'] += 1
+
+    def close_all(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            if session.client is not None:
+                session.client.close()
+
+    def _release(self, session):
+        with self._lock:
+            session.users -= 1
+            session.last_used = self.clock()
+            close = session.discarded and not session.users
+        if close and session.client is not None:
+            session.client.close()
+
+    @contextlib.contextmanager
+    def _using(self, vm):
+        # Sessions with users are never evicted, however long they're used.
+        # If the transport turns out to be broken the session is discarded,
+        # so the next user reconnects.
+        self.evict_idle()
+        session = self._session(vm, use=True)
+        try:
+            yield self._connect(session, vm)
+        except SESSION_ERRORS:
+            with self._lock:
+                if self._sessions.get(vm.name()) is session:
+                    del self._sessions[vm.name()]
+                # closed by _release once its other users are done too
+                session.discarded = True
+            raise
+        finally:
+            self._release(session)
+
+    @contextlib.contextmanager
+    def channel(self, vm):
+        """
+        Yields a new session channel on the pooled transport of 'vm'.
+        """
+        with self._using(vm) as client:
+            channel = client.get_transport().open_session()
+            try:
+                yield channel
+            finally:
+                channel.close()
+
+    @contextlib.contextmanager
+    def sftp(self, vm):
+        with self._using(vm) as client:
+            sftp = client.open_sftp()
+            try:
+                yield sftp
+            finally:
+                sftp.close()
+
+    def ssh(self, vm, command, data=None, chunk_size=1 << 16):
+        """
+        Like vm.ssh, runs 'command' (a list which is joined with spaces)
+        and returns its CommandStatus, without a handshake per command.
+        """
+        with self.channel(vm) as channel:
+            channel.exec_command(' '.join(command))
+            if data is not None:
+                channel.sendall(data)
+                channel.shutdown_write()
+            out, err = [], []
+            while True:
+                if channel.recv_ready():
+                    out.append(channel.recv(chunk_size))
+                elif channel.recv_stderr_ready():
+                    err.append(channel.recv_stderr(chunk_size))
+                elif channel.exit_status_ready():
+                    break
+                else:
+                    select.select([channel], [], [], 0.1)
+            # whatever arrived after the exit status
+            while channel.recv_ready():
+                out.append(channel.recv(chunk_size))
+            while channel.recv_stderr_ready():
+                err.append(channel.recv_stderr(chunk_size))
+
+            return CommandStatus(
+                channel.recv_exit_status(),
+                b''.join(out).decode('utf-8', 'replace'),
+                b''.join(err).decode('utf-8', 'replace'),
+            )
+
+    def copy_from(self, vm, remote_path, local_path):
+        with self.sftp(vm) as sftp:
+            sftp.get(remote_path, local_path)
+
+    def copy_to(self, vm, local_path, remote_path):
+        with self.sftp(vm) as sftp:
+            sftp.put(local_path, remote_path)
+
+    def ssh_reachable(self, vm, tries=1):
+        """
+        Fast reachability probe, a live session answers with a single
+        channel round trip. Otherwise up to 'tries' connection attempts
+        are made.
+        """
+        for _ in range(tries):
+            try:
+                return self.ssh(vm, ['true']).code == 0
+            except CONNECT_ERRORS:
+                time.sleep(1)
+        return False
+
+    def wait_for_ssh(self, vm, tries=100):
+        if not self.ssh_reachable(vm, tries):
+            raise RuntimeError('%s is not reachable through ssh' % vm.name())
+
+
+_ssh_pool = SSHPool()
+
+
+def get_ssh_pool():
+    return _ssh_pool
+
+
+def set_ssh_pool(pool):
+    global _ssh_pool
+    _ssh_pool = pool
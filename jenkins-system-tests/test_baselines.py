@@ -0,0 +1,36 @@
+'''
+
+Checks of the baseline store, no VMs needed:
+    python -m pytest -v test_baselines.py
+
+'''
+import functools
+
+import baselines
+import testlib
+
+
+def _record(path, index):
+    store = baselines.BaselineStore(path)
+    try:
+        return store.record({'test:x': index}, 'rev', 'env')
+    finally:
+        store.close()
+
+
+def test_concurrent_runs_get_their_own_ids(tmpdir):
+    path = str(tmpdir.join('baselines.db'))
+    baselines.BaselineStore(path).close()
+
+    run_ids = testlib.run_concurrently(
+        [functools.partial(_record, path, index) for index in range(20)],
+        max_workers=20
+    )
+
+    assert sorted(run_ids) == list(range(1, 21))
+
+
+def test_merge_durations():
+    assert baselines.merge_durations(
+        [{'test:a': 1, 'fixture:env': 2}, {}, {'fixture:env': 3}]
+    ) == {'test:a': 1, 'fixture:env': 5}
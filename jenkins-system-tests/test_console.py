@@ -0,0 +1,87 @@
+'''
+
+Checks of the console streaming, no VMs needed:
+    python -m pytest -v test_console.py
+
+'''
+import collections
+
+import pytest
+import requests
+
+import console
+
+Build = collections.namedtuple('Build', ['job', 'number'])
+
+
+class _Response(object):
+    def __init__(self, chunks, size, more, fail_after=None):
+        self.chunks = chunks
+        self.fail_after = fail_after
+        self.headers = {
+            'X-Text-Size': str(size),
+            'X-More-Data': 'true' if more else 'false',
+        }
+
+    def iter_content(self, chunk_size):
+        for index, chunk in enumerate(self.chunks):
+            if index == self.fail_after:
+                raise requests.ConnectionError('connection reset')
+            yield chunk
+
+    def close(self):
+        pass
+
+
+class _Jenkins(object):
+    """
+    Serves 'text' as the console output of every build, the fetches
+    listed in 'failures' break off after that many chunks.
+    """
+
+    def __init__(self, text, failures=None):
+        self.text = text
+        self.failures = dict(failures or {})
+        self.fetches = 0
+
+    def _build_url(self, path, variables):
+        return 'http://jenkins/' + path % variables
+
+    def jenkins_request(self, request, stream=False):
+        start = int(request.get_full_url().rsplit('=', 1)[1])
+        rest = self.text[start:]
+        fail_after = self.failures.get(self.fetches)
+        self.fetches += 1
+        return _Response(
+            [rest[i:i + 5] for i in range(0, len(rest), 5)],
+            len(self.text),
+            more=False,
+            fail_after=fail_after,
+        )
+
+
+def test_mid_stream_failure_is_not_written_twice(tmpdir):
+    text = b'0123456789' * 3
+    streamer = console.ConsoleStreamer(
+        _Jenkins(text, failures={0: 3}), str(tmpdir)
+    )
+    streamer.follow(Build('job', 1))
+
+    assert streamer.poll() == 1
+    assert isinstance(streamer.last_error, requests.ConnectionError)
+    assert streamer.poll() == 0
+    streamer.stop()
+
+    assert tmpdir.join('job-1.log').read_binary() == text
+
+
+def test_stop_reports_incomplete_output(tmpdir):
+    streamer = console.ConsoleStreamer(
+        _Jenkins(b'0123456789', failures={0: 1, 1: 1}), str(tmpdir)
+    )
+    streamer.follow(Build('job', 1))
+    streamer.poll()
+
+    with pytest.raises(RuntimeError, match='job-1'):
+        streamer.stop()
+    assert tmpdir.join('job-1.log').read_binary() == b'01234'
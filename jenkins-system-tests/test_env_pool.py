@@ -0,0 +1,139 @@
+'''
+
+Checks of the environment pool on fake Lago environments, no VMs needed:
+    python -m pytest -v test_env_pool.py
+
+'''
+import multiprocessing
+import os
+
+import pytest
+
+import env_pool
+import fake_lago
+import testlib
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG = os.path.join(TESTS_DIR, 'init-jenkins.yaml')
+SOURCES = [CONFIG, os.path.join(TESTS_DIR, 'ansible')]
+FAST_POLICY = testlib.WaitPolicy(first_delay=0.01, max_delay=0.05)
+
+
+def _pool(tmpdir, size):
+    sdk_root = tmpdir.join('sdk')
+    sdk_root.ensure(dir=True)
+    return env_pool.EnvPool(
+        fake_lago.FakeSDK(str(sdk_root)), str(tmpdir.join('pool')), size,
+        CONFIG, SOURCES
+    )
+
+
+def _deploy(pool, lease):
+    env = pool._load(lease.slot)
+    env.start()
+    testlib.Deployment(env, *SOURCES).save()
+
+
+def test_lease_and_release(tmpdir):
+    pool = _pool(tmpdir, 1)
+
+    lease = pool.lease(policy=FAST_POLICY)
+    assert lease.slot.state() == (env_pool.DIRTY, None)
+    assert lease.snapshot is None and lease.reset is None
+    _deploy(pool, lease)
+    pool.release(lease)
+    pool.wait_for_resets()
+
+    assert pool.errors == []
+    assert pool.occupancy()[env_pool.CLEAN] == 1
+    lease = pool.lease(policy=FAST_POLICY)
+    assert lease.snapshot == testlib.Deployment(
+        pool._load(lease.slot), *SOURCES
+    ).snapshot_name
+    assert lease.reset is not None
+
+
+def test_killed_session_is_reset_on_lease(tmpdir):
+    pool = _pool(tmpdir, 1)
+    lease = pool.lease(policy=FAST_POLICY)
+    _deploy(pool, lease)
+    # the session dies, the kernel drops its lock
+    lease.slot.unlock()
+
+    lease = pool.lease(policy=FAST_POLICY)
+
+    assert lease.snapshot is not None
+    assert lease.reset is not None
+    assert lease.slot.state()[0] == env_pool.DIRTY
+
+
+def test_free_slots_are_leased_first(tmpdir):
+    pool = _pool(tmpdir, 2)
+    first = pool.lease(policy=FAST_POLICY)
+    second = pool.lease(policy=FAST_POLICY)
+
+    assert first.slot.index != second.slot.index
+    assert first.config != second.config
+    assert pool.occupancy()['leased'] == 2
+    with pytest.raises(RuntimeError):
+        pool.lease(timeout=0.1, policy=FAST_POLICY)
+
+
+def test_pool_subnets_are_apart_from_workers(tmpdir):
+    pool = _pool(tmpdir, 1)
+    lease = pool.lease(policy=FAST_POLICY)
+    worker = testlib.worker_config(CONFIG, str(tmpdir), 'gw0')
+
+    assert open(lease.config).read() != open(worker).read()
+    assert '192.168.%d.1' % testlib.POOL_FIRST_OCTET in open(
+        lease.config
+    ).read()
+
+
+def _hold_lease(tmpdir, leased, done):
+    lease = _pool(tmpdir, 2).lease(policy=FAST_POLICY)
+    leased.put(lease.slot.index)
+    done.wait(10)
+
+
+def test_two_processes_get_different_slots(tmpdir):
+    leased = multiprocessing.Queue()
+    done = multiprocessing.Event()
+    holder = multiprocessing.Process(
+        target=_hold_lease, args=(tmpdir, leased, done)
+    )
+    holder.start()
+    try:
+        held = leased.get(timeout=10)
+        pool = _pool(tmpdir, 2)
+        lease = pool.lease(policy=FAST_POLICY)
+
+        assert lease.slot.index != held
+        with pytest.raises(RuntimeError):
+            pool.lease(timeout=0.1, policy=FAST_POLICY)
+    finally:
+        done.set()
+        holder.join()
+
+    # the holder exited without releasing, its slot is free again
+    assert pool.lease(policy=FAST_POLICY).slot.index == held
+
+
+def test_warm_deploys_free_slots(tmpdir, monkeypatch):
+    deployed = []
+
+    def _deploy_playbook(env, playbook):
+        deployed.append(playbook)
+        return 0
+
+    monkeypatch.setattr(testlib, 'deploy_ansible_playbook', _deploy_playbook)
+    pool = _pool(tmpdir, 3)
+    leased = pool.lease(policy=FAST_POLICY)
+
+    assert pool.warm('playbook.yaml') == [True, True]
+    assert deployed == ['playbook.yaml'] * 2
+    assert pool.occupancy() == {
+        'leased': 1, env_pool.CLEAN: 2, env_pool.NEW: 0, env_pool.DIRTY: 0
+    }
+    assert pool.lease(policy=FAST_POLICY).snapshot is not None
+    assert leased.slot.state()[0] == env_pool.DIRTY
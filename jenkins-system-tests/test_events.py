@@ -0,0 +1,109 @@
+'''
+
+Checks of the event listener, driven without a Jenkins:
+    python -m pytest -v test_events.py
+
+'''
+import threading
+import time
+
+import pytest
+
+import events
+
+
+@pytest.fixture
+def start_listener():
+    started = []
+
+    def _start(max_events=1000):
+        listener = events.EventListener('127.0.0.1', max_events=max_events)
+        listener.start()
+        started.append(listener)
+        return listener
+
+    yield _start
+    for listener in started:
+        listener.stop()
+
+
+@pytest.fixture
+def listener(start_listener):
+    return start_listener()
+
+
+def test_events_are_kept_in_order(listener):
+    events.notify_node(listener.url, 'slave-0')
+    events.notify_build(listener.url, 'job', 1, 'STARTED')
+    events.notify_build(listener.url, 'job', 1, 'FINALIZED', 'SUCCESS')
+    events.notify_node(listener.url, 'slave-0', 'offline')
+
+    assert list(listener.events) == [
+        {'node': 'slave-0', 'event': 'online'},
+        {'name': 'job', 'build': {
+            'number': 1, 'phase': 'STARTED', 'status': None
+        }},
+        {'name': 'job', 'build': {
+            'number': 1, 'phase': 'FINALIZED', 'status': 'SUCCESS'
+        }},
+        {'node': 'slave-0', 'event': 'offline'},
+    ]
+
+
+def test_only_the_last_events_are_kept(start_listener):
+    listener = start_listener(max_events=3)
+    for number in range(5):
+        events.notify_build(listener.url, 'job', number, 'STARTED')
+
+    assert listener.recorded == 5
+    assert [event['build']['number'] for event in listener.events] == [
+        2, 3, 4
+    ]
+
+
+def test_waiter_after_overflow(start_listener):
+    listener = start_listener(max_events=3)
+    early = listener.node_waiter(['slave-0'])
+    late = listener.node_waiter(['slave-4'])
+    for index in range(5):
+        events.notify_node(listener.url, 'slave-%d' % index)
+
+    # slave-0's event was dropped before the waiter looked at it
+    assert not early(0)
+    assert late(0)
+
+
+def test_waiter_only_counts_new_events(listener):
+    events.notify_node(listener.url, 'slave-0')
+    wait = listener.node_waiter(['slave-0'])
+
+    assert not wait(0.05)
+    events.notify_node(listener.url, 'slave-0', 'offline')
+    assert not wait(0.05)
+    events.notify_node(listener.url, 'slave-0')
+    assert wait(0)
+    assert not wait(0)
+
+
+def test_waiter_wakes_up_on_event(listener):
+    wait = listener.build_waiter(['job'])
+    notifier = threading.Timer(
+        0.1, events.notify_build, (listener.url, 'job', 1, 'STARTED')
+    )
+    notifier.start()
+    start = time.time()
+
+    try:
+        assert wait(5)
+    finally:
+        notifier.join()
+    assert time.time() - start < 2
+
+
+def test_waiter_times_out(listener):
+    wait = listener.build_waiter(['job'])
+    events.notify_build(listener.url, 'other-job', 1, 'STARTED')
+    start = time.time()
+
+    assert not wait(0.2)
+    assert time.time() - start >= 0.2
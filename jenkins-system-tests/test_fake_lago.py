@@ -0,0 +1,180 @@
+'''
+
+Checks of the fake Lago SDK and a benchmark of it at 100 slaves, no VMs
+needed:
+    python -m pytest -v test_fake_lago.py
+
+'''
+import os
+
+import pytest
+
+import fake_lago
+import ssh_pool
+import testlib
+
+INIT_CONFIG = os.path.join(os.path.dirname(__file__), 'init-jenkins.yaml')
+
+
+@pytest.fixture
+def pool():
+    previous = ssh_pool.get_ssh_pool()
+    pool = ssh_pool.SSHPool()
+    ssh_pool.set_ssh_pool(pool)
+    yield pool
+    pool.close_all()
+    ssh_pool.set_ssh_pool(previous)
+
+
+def _start_env(tmpdir, name='env', **kwargs):
+    sdk = fake_lago.FakeSDK(str(tmpdir.mkdir(name)), **kwargs)
+    env = sdk.init(INIT_CONFIG, workdir=str(tmpdir.join(name + '-workdir')))
+    env.start()
+    return sdk, env
+
+
+@pytest.mark.parametrize(
+    'command,expected', [
+        ('cat /var/log/x', 'cat ROOT/var/log/x'),
+        ('/bin/true', 'ROOT/bin/true'),
+        ("cd '/var/lib' && ls", "cd 'ROOT/var/lib' && ls"),
+        ('touch -d @0 /a; x=/b', 'touch -d @0 ROOT/a; x=ROOT/b'),
+        ('ls 2>/dev/null /dev/null', 'ls 2>/dev/null /dev/null'),
+        ('ls var/tmp ./x', 'ls var/tmp ./x'),
+    ]
+)
+def test_rooted_paths(command, expected):
+    assert fake_lago._rooted('ROOT', command) == expected
+
+
+def test_vms_from_init_config(tmpdir):
+    _, env = _start_env(tmpdir)
+    vms = env.get_vms()
+
+    assert list(vms) == [
+        'jenkins-master', 'jenkins-slave-0', 'jenkins-slave-1'
+    ]
+    assert vms['jenkins-master'].groups == ['jenkins-masters']
+    assert vms['jenkins-slave-1'].metadata == {'jenkins-label': 'qa'}
+    assert vms['jenkins-slave-0']._artifact_paths() == ['/var/log']
+    assert all(vm.running for vm in vms.values())
+
+
+def test_scale_slaves_round_robin(tmpdir):
+    _, env = _start_env(tmpdir, slaves=5)
+    vms = env.get_vms()
+    slaves = [vm for vm in vms.values() if 'jenkins-slaves' in vm.groups]
+
+    assert len(vms) == 6
+    assert sorted(vm.name() for vm in slaves) == [
+        'jenkins-slave-%d' % index for index in range(5)
+    ]
+    assert [
+        vms['jenkins-slave-%d' % index].metadata['jenkins-label']
+        for index in range(5)
+    ] == ['dev', 'qa', 'dev', 'qa', 'dev']
+
+
+def test_prefix_already_exists(tmpdir):
+    sdk, env = _start_env(tmpdir)
+
+    with pytest.raises(fake_lago.PrefixAlreadyExists):
+        sdk.init(INIT_CONFIG, workdir=str(tmpdir.join('env-workdir')))
+    assert sdk.load_env(str(tmpdir.join('env-workdir'))) is env
+
+
+def test_ssh_output_stderr_and_exit_status(tmpdir, pool):
+    _, env = _start_env(tmpdir)
+    vm = env.get_vms()['jenkins-master']
+    with open(vm.path('/var/tmp/file'), 'w') as f:
+        f.write('content\n')
+
+    result = vm.ssh(
+        ['cat', '/var/tmp/file', '>&2;', 'echo', 'out;', 'exit', '3']
+    )
+
+    assert result == ssh_pool.CommandStatus(3, 'out\n', 'content\n')
+    assert vm.ssh(['cat'], data=b'stdin') == ssh_pool.CommandStatus(
+        0, 'stdin', ''
+    )
+
+
+def test_large_stderr_does_not_block_stdout(tmpdir, pool):
+    _, env = _start_env(tmpdir)
+    vm = env.get_vms()['jenkins-master']
+
+    result = vm.ssh(
+        ['yes', '|', 'head', '-c', '3000000', '>&2;', 'echo', 'done']
+    )
+
+    assert result.code == 0
+    assert result.out == 'done\n'
+    assert len(result.err) == 3000000
+
+
+def test_ssh_needs_a_running_vm(tmpdir, pool):
+    _, env = _start_env(tmpdir)
+    vm = env.get_vms()['jenkins-master']
+    vm.stop()
+
+    with pytest.raises(RuntimeError):
+        vm._get_ssh_client()
+
+
+def test_copy_and_collect(tmpdir, pool):
+    _, env = _start_env(tmpdir)
+    vm = env.get_vms()['jenkins-slave-0']
+    local = tmpdir.join('local')
+    local.write('data')
+
+    vm.copy_to(str(local), '/var/log/copied')
+    vm.copy_from('/var/log/copied', str(tmpdir.join('back')))
+    env.collect_artifacts(str(tmpdir.mkdir('collected')))
+
+    assert tmpdir.join('back').read() == 'data'
+    assert tmpdir.join(
+        'collected', 'jenkins-slave-0', 'var_log', 'copied'
+    ).read() == 'data'
+
+
+def test_snapshot_revert(tmpdir, pool):
+    _, env = _start_env(tmpdir)
+    deployment = testlib.Deployment(env, INIT_CONFIG)
+    vm = env.get_vms()['jenkins-master']
+    with open(vm.path('/var/tmp/deployed'), 'w') as f:
+        f.write('yes')
+    deployment.save()
+    os.remove(vm.path('/var/tmp/deployed'))
+    with open(vm.path('/var/tmp/leftover'), 'w') as f:
+        f.write('yes')
+
+    assert deployment.has_snapshot()
+    assert deployment.restore()
+    assert os.path.isfile(vm.path('/var/tmp/deployed'))
+    assert not os.path.exists(vm.path('/var/tmp/leftover'))
+    assert vm.ssh(['cat', '/var/tmp/deployed']).out == 'yes'
+
+
+def test_start_ssh_and_revert_100_slaves(benchmark, tmpdir, pool):
+    rounds = iter(range(1000))
+
+    def _run():
+        _, env = _start_env(
+            tmpdir,
+            name='env-%d' % next(rounds),
+            slaves=100,
+            boot_latency=0.05,
+            ssh_latency=0.01,
+        )
+        vms = list(env.get_vms().values())
+        testlib.run_concurrently(
+            [lambda vm=vm: pool.wait_for_ssh(vm, tries=1) for vm in vms],
+            max_workers=len(vms)
+        )
+        deployment = testlib.Deployment(env, INIT_CONFIG)
+        deployment.save()
+        assert deployment.restore()
+        return env
+
+    env = benchmark.pedantic(_run, rounds=3)
+    assert len(env.get_vms()) == 101
@@ -0,0 +1,36 @@
+'''
+
+Checks of the load report statistics, no VMs needed:
+    python -m pytest -v test_loadgen.py
+
+'''
+import pytest
+
+import loadgen
+
+
+@pytest.mark.parametrize(
+    'values,p,expected', [
+        (range(1, 11), 50, 5),
+        (range(1, 11), 90, 9),
+        (range(1, 11), 95, 10),
+        (range(1, 11), 99, 10),
+        (range(1, 11), 100, 10),
+        (range(1, 11), 0, 1),
+        ([1, 2], 50, 1),
+        ([1, 2], 51, 2),
+        ([7], 99, 7),
+        (range(1, 101), 95, 95),
+        ([], 50, None),
+    ]
+)
+def test_percentile_nearest_rank(values, p, expected):
+    assert loadgen.percentile(list(values), p) == expected
+
+
+def test_distribution_skips_missing_values():
+    summary = loadgen.distribution([None, 3, 1, 2, None])
+
+    assert summary == {
+        'p50': 2, 'p90': 3, 'p95': 3, 'p99': 3, 'max': 3, 'count': 3
+    }
@@ -0,0 +1,197 @@
+'''
+
+Checks of the testlib helpers which need neither VMs nor Jenkins:
+    python -m pytest -v test_testlib.py
+
+'''
+import io
+import os
+import tarfile
+import threading
+import time
+import zipfile
+
+import pytest
+
+import fake_lago
+import ssh_pool
+import testlib
+
+
+def _make_tree(root):
+    root.join('init.yaml').write('domains: {}')
+    root.join('ansible', 'site.yml').write('- hosts: all', ensure=True)
+    return [str(root.join('init.yaml')), str(root.join('ansible'))]
+
+
+def test_tree_digest_ignores_location(tmpdir, monkeypatch):
+    first = _make_tree(tmpdir.mkdir('first'))
+    second = _make_tree(tmpdir.mkdir('second'))
+    monkeypatch.chdir(str(tmpdir.join('first')))
+
+    assert testlib.tree_digest(*first) == testlib.tree_digest(*second)
+    assert testlib.tree_digest(*first) == testlib.tree_digest(
+        'init.yaml', 'ansible'
+    )
+
+
+def test_tree_digest_skips_run_files(tmpdir):
+    sources = _make_tree(tmpdir)
+    before = testlib.tree_digest(*sources)
+    tmpdir.join('ansible', 'site.retry').write('host')
+    tmpdir.join('ansible', '__pycache__', 'cb.pyc').write('', ensure=True)
+
+    assert testlib.tree_digest(*sources) == before
+
+
+def test_tree_digest_tracks_names_and_contents(tmpdir):
+    sources = _make_tree(tmpdir)
+    before = testlib.tree_digest(*sources)
+    tmpdir.join('ansible', 'site.yml').write('- hosts: none')
+    changed = testlib.tree_digest(*sources)
+    os.rename(
+        str(tmpdir.join('ansible', 'site.yml')),
+        str(tmpdir.join('ansible', 'other.yml'))
+    )
+
+    assert len(set([before, changed, testlib.tree_digest(*sources)])) == 3
+
+
+def _tar(members):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as archive:
+        for name, kind in members:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            if kind == tarfile.SYMTYPE:
+                info.linkname = '/etc/passwd'
+            archive.addfile(info, io.BytesIO(b''))
+    data.seek(0)
+    return tarfile.open(fileobj=data, mode='r')
+
+
+@pytest.mark.parametrize(
+    'name,kind', [
+        ('../outside', tarfile.REGTYPE),
+        ('dir/../../outside', tarfile.REGTYPE),
+        ('/etc/outside', tarfile.REGTYPE),
+        ('link', tarfile.SYMTYPE),
+        ('fifo', tarfile.FIFOTYPE),
+    ]
+)
+def test_tar_members_outside_local_dir_are_rejected(tmpdir, name, kind):
+    archive = _tar([('inside', tarfile.REGTYPE), (name, kind)])
+
+    with pytest.raises(RuntimeError, match='unsafe archive member'):
+        list(testlib._checked_members(archive, str(tmpdir)))
+
+
+def test_tar_members_inside_local_dir_pass(tmpdir):
+    archive = _tar([('dir', tarfile.DIRTYPE), ('dir/file', tarfile.REGTYPE)])
+
+    assert [
+        member.name
+        for member in testlib._checked_members(archive, str(tmpdir))
+    ] == ['dir', 'dir/file']
+
+
+def test_fetch_archive_from_vm(tmpdir):
+    sdk = fake_lago.FakeSDK(str(tmpdir.mkdir('sdk')))
+    env = sdk.init(
+        os.path.join(os.path.dirname(__file__), 'init-jenkins.yaml')
+    )
+    env.start()
+    vm = env.get_vms()['jenkins-master']
+    os.makedirs(vm.path('/var/tmp/artifacts/dir'))
+    for name in ['a.txt', 'dir/b.txt']:
+        with open(vm.path('/var/tmp/artifacts/' + name), 'w') as f:
+            f.write(name)
+    local_dir = str(tmpdir.join('local'))
+
+    try:
+        fetched = testlib.fetch_archive(vm, '/var/tmp/artifacts', local_dir)
+        refetched = testlib.fetch_archive(
+            vm, '/var/tmp/artifacts', local_dir
+        )
+    finally:
+        ssh_pool.get_ssh_pool().close_all()
+
+    assert fetched == ['a.txt', 'dir/b.txt']
+    assert refetched == []
+    assert tmpdir.join('local', 'dir', 'b.txt').read() == 'dir/b.txt'
+
+
+class _Response(object):
+    def __init__(self, data):
+        self.data = data
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+
+class _Jenkins(object):
+    def __init__(self, entries):
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, mode='w') as archive:
+            for name, content in entries:
+                archive.writestr(name, content)
+        self.data = data.getvalue()
+
+    def _build_url(self, path, variables):
+        return 'http://jenkins/' + path % variables
+
+    def jenkins_request(self, request, stream=False):
+        return _Response(self.data)
+
+
+def test_fetch_archive_zip(tmpdir):
+    jenkins_api = _Jenkins(
+        [('archive/a.txt', b'a'), ('archive/dir/b.txt', b'b')]
+    )
+    local_dir = tmpdir.join('local')
+
+    fetched = testlib.fetch_archive_zip(jenkins_api, 'job', str(local_dir))
+
+    assert fetched == ['a.txt', 'dir/b.txt']
+    assert local_dir.join('dir', 'b.txt').read() == 'b'
+    assert testlib.fetch_archive_zip(jenkins_api, 'job', str(local_dir)) == []
+
+
+@pytest.mark.parametrize(
+    'name', ['archive/../outside.txt', 'archive//tmp/outside.txt']
+)
+def test_fetch_archive_zip_rejects_entries_outside_local_dir(tmpdir, name):
+    jenkins_api = _Jenkins([('archive/a.txt', b'a'), (name, b'evil')])
+    local_dir = tmpdir.join('local')
+
+    with pytest.raises(RuntimeError, match='unsafe archive member'):
+        testlib.fetch_archive_zip(jenkins_api, 'job', str(local_dir))
+    assert not tmpdir.join('outside.txt').exists()
+    assert not local_dir.join('a.txt').exists()
+
+
+def test_wait_for_all_stops_on_a_hard_failure():
+    def _broken():
+        raise ValueError('broken')
+
+    conditions = dict(('slow-%d' % index, lambda: False) for index in range(3))
+    conditions['broken'] = _broken
+    start = time.time()
+
+    with pytest.raises(ValueError):
+        testlib.wait_for_all(
+            conditions, 30, until=bool, policy=testlib.WaitPolicy(max_delay=5)
+        )
+    assert time.time() - start < 2
+
+
+def test_cancelled_wait_is_not_done():
+    cancel = threading.Event()
+    cancel.set()
+
+    result = testlib.get_wait_engine().wait(lambda: True, 30, cancel=cancel)
+
+    assert result.cancelled
+    assert not result.done
+    assert result.polls == 0
@@ -1,32 +1,540 @@
-import lago.lago_ansible as lago_ansible
-from lago import utils
+try:
+    import lago.lago_ansible as lago_ansible
+    from lago import utils
+except ImportError:
+    # Only the deployment needs Lago, the rest works against any VM like
+    # objects, e.g. the ones of fake_lago, or without VMs at all
+    lago_ansible = utils = None
 import itertools
+import fnmatch
+import os
+import hashlib
+import tarfile
+import tempfile
+import zipfile
+import zlib
+import shutil
 import jenkins
+import json
 from six.moves.urllib.request import Request, urlopen
 from six.moves.urllib.parse import quote, urlencode, urljoin, urlparse
 from six.moves.urllib.error import HTTPError, URLError
 import time
 import socket
+import functools
+import random
+import threading
+import yaml
+from six.moves import http_client, queue, shlex_quote
+import ssh_pool
 
 SHORT_TIMEOUT = 3 * 60
 LONG_TIMEOUT = 10 * 60
 
+CREDENTIALS_CLASS = (
+    'com.cloudbees.plugins.credentials.impl.UsernamePasswordCredentialsImpl'
+)
 
-def deploy_ansible_playbook(env, playbook_path):
 
-    with env.ansible_inventory_temp_file(keys=['groups']) as inventory:
-        cmd = [
-            'ansible-playbook',
-            playbook_path,
-            '-i',
-            inventory.name,
-            '-u',
-            'root',
+# Facts are cached here across runs, under a directory per environment
+ANSIBLE_FACTS_ROOT = '/tmp/lago-ansible-facts'
+
+
+def fast_ansible_env(vm_count, results_path, facts_path=None):
+    """
+    Ansible settings for the fast deploy mode: SSH pipelining and
+    persistent control connections, a fork per VM, facts cached in
+    'facts_path' (defaults to 'results_path') and per task timings
+    reported to '<results_path>/ansible_timings.json' by the task_timings
+    callback.
+    """
+    return {
+        'ANSIBLE_PIPELINING': 'True',
+        'ANSIBLE_SSH_ARGS': '-o ControlMaster=auto -o ControlPersist=300s',
+        'ANSIBLE_FORKS': str(max(5, vm_count)),
+        'ANSIBLE_GATHERING': 'smart',
+        'ANSIBLE_CACHE_PLUGIN': 'jsonfile',
+        'ANSIBLE_CACHE_PLUGIN_CONNECTION':
+            facts_path or os.path.join(results_path, 'ansible_facts'),
+        'ANSIBLE_CACHE_PLUGIN_TIMEOUT': '86400',
+        'ANSIBLE_CALLBACK_WHITELIST': 'task_timings',
+        'ANSIBLE_CALLBACKS_ENABLED': 'task_timings',
+        'TASK_TIMINGS_PATH':
+            os.path.join(results_path, 'ansible_timings.json'),
+    }
+
+
+def _run_playbook(playbook_path, inventory_path, ansible_env):
+    cmd = [
+        'ansible-playbook',
+        playbook_path,
+        '-i',
+        inventory_path,
+        '-u',
+        'root',
+    ]
+    ansible_env['ANSIBLE_HOST_KEY_CHECKING'] = 'False'
+
+    return utils.run_interactive_command(cmd, env=ansible_env)
+
+
+def deploy_ansible_playbook(env, playbook_path, results_path=None):
+    """
+    Run 'playbook_path' on all the VMs in 'env'. When 'results_path' is
+    given, the playbook runs in fast mode (see fast_ansible_env) and the
+    inventory is written there once and reused by later deployments.
+    The facts are cached under ANSIBLE_FACTS_ROOT, in a directory named
+    after the inventory, so they outlive the results of the run.
+    """
+    if results_path is None:
+        with env.ansible_inventory_temp_file(keys=['groups']) as inventory:
+            return _run_playbook(playbook_path, inventory.name, {})
+
+    inventory_path = os.path.join(results_path, 'inventory')
+    if not os.path.isfile(inventory_path):
+        with open(inventory_path, 'w') as f:
+            f.write(env.ansible_inventory(keys=['groups']))
+    # the inventory holds the names and addresses of the VMs, so
+    # concurrent environments never share facts
+    facts_path = os.path.join(
+        ANSIBLE_FACTS_ROOT, _sha256(inventory_path)[:12]
+    )
+
+    return _run_playbook(
+        playbook_path,
+        inventory_path,
+        fast_ansible_env(len(env.get_vms()), results_path, facts_path),
+    )
+
+
+# Names of files and directories tree_digest skips, the ones the runs
+# themselves create, e.g. the compiled callback plugin and retry files
+DIGEST_IGNORED = ['__pycache__', '*.pyc', '*.retry']
+
+
+def _digest_ignored(name):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in DIGEST_IGNORED)
+
+
+def tree_digest(*paths):
+    """
+    sha256 over the relative names and contents of all the files under
+    'paths', which may be files or directories, except DIGEST_IGNORED.
+    Names are relative to the parent of their path, so the digest doesn't
+    depend on where the tree is or how it's reached.
+    """
+    digest = hashlib.sha256()
+    for top in paths:
+        parent = os.path.dirname(os.path.abspath(top))
+        if os.path.isfile(top):
+            files = [top]
+        else:
+            files = []
+            for root, dirs, names in os.walk(top):
+                dirs[:] = [name for name in dirs if not _digest_ignored(name)]
+                files.extend(
+                    os.path.join(root, name)
+                    for name in names if not _digest_ignored(name)
+                )
+        for path in sorted(files):
+            name = os.path.relpath(os.path.abspath(path), parent)
+            digest.update(name.encode('utf-8') + b'\0')
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+            digest.update(b'\0')
+
+    return digest.hexdigest()
+
+
+def worker_index(worker_id):
+    """
+    0 for 'master' (not running under pytest-xdist), n + 1 for 'gw<n>'.
+    """
+    if worker_id == 'master':
+        return 0
+    return int(worker_id.lstrip('gw')) + 1
+
+
+def worker_workdir(workdir, worker_id):
+    if worker_id == 'master':
+        return workdir
+    return '%s-%s' % (workdir, worker_id)
+
+
+def worker_prefix_name(worker_id):
+    if worker_id == 'master':
+        return 'default'
+    return 'jenkins-%s' % worker_id
+
+
+# The third octets of the NAT subnets of pytest-xdist workers start at
+# WORKER_FIRST_OCTET, the ones of pooled environments at POOL_FIRST_OCTET
+# and end right before the workers' ones, so the two never overlap
+WORKER_FIRST_OCTET = 210
+POOL_FIRST_OCTET = 160
+
+
+def isolated_config(
+    config, output_dir, index, first_octet=WORKER_FIRST_OCTET, last_octet=255
+):
+    """
+    Returns the path of a copy of the init config 'config' in which the
+    NAT networks get gateways of their own, the 'index'th (from 0) set
+    of subnets from 192.168.<first_octet>.0 up to 192.168.<last_octet>.0,
+    so environments with different indexes never share a subnet.
+    """
+    with open(config, mode='rt') as f:
+        spec = yaml.safe_load(f)
+    nat_nets = sorted(
+        name for name, net in spec.get('nets', {}).items()
+        if net.get('type') == 'nat'
+    )
+    first = first_octet + index * len(nat_nets)
+    if first + len(nat_nets) > last_octet + 1:
+        raise RuntimeError('no subnets left for environment %d' % index)
+    for offset, name in enumerate(nat_nets):
+        spec['nets'][name]['gw'] = '192.168.%d.1' % (first + offset)
+
+    path = os.path.join(output_dir, os.path.basename(config))
+    with open(path, mode='wt') as f:
+        yaml.safe_dump(spec, f, default_flow_style=False)
+
+    return path
+
+
+def worker_config(
+    config, output_dir, worker_id, first_octet=WORKER_FIRST_OCTET
+):
+    """
+    Returns the path of a copy of the init config 'config' in which the
+    NAT networks of every pytest-xdist worker get their own gateway, so
+    the environments of concurrent workers never share a subnet.
+    Without xdist 'config' is returned as is and Lago allocates the
+    subnets.
+    """
+    if worker_id == 'master':
+        return config
+
+    return isolated_config(
+        config, output_dir, worker_index(worker_id) - 1, first_octet
+    )
+
+
+class Deployment(object):
+    """
+    Lago snapshot of an environment right after a successful deployment,
+    named after the digest of everything the deployment depends on, e.g.
+    the init config and the playbook tree. A change to any of them yields
+    a new name, so stale snapshots are never reverted to.
+    """
+
+    def __init__(self, env, *sources):
+        self.env = env
+        self.snapshot_name = 'deployed-%s' % tree_digest(*sources)[:12]
+        # Set when the env is known to be at the snapshot already, e.g.
+        # it was leased from an EnvPool which reverted it
+        self.restored = False
+
+    def has_snapshot(self):
+        snapshots = self.env.get_snapshots()
+        return bool(snapshots) and all(
+            self.snapshot_name in names for names in snapshots.values()
+        )
+
+    def restore(self):
+        if self.restored:
+            return True
+        if not self.has_snapshot():
+            return False
+
+        self.env.revert_snapshots(self.snapshot_name)
+        pool = ssh_pool.get_ssh_pool()
+        for vm in self.env.get_vms().values():
+            # the pooled sessions belong to the VMs' state before the revert
+            pool.discard(vm)
+            pool.wait_for_ssh(vm)
+        return True
+
+    def save(self):
+        if not self.has_snapshot():
+            self.env.create_snapshots(self.snapshot_name)
+
+
+ARTIFACTS_STAMP = '/var/tmp/lago-artifacts.stamp'
+
+
+def _artifacts_command(paths, include, exclude, max_size, incremental):
+    find = ['find'] + [shlex_quote(path) for path in paths] + [
+        '-xdev', '-type', 'f'
+    ]
+    if max_size is not None:
+        find += ['-size', '-%dc' % (max_size + 1)]
+    if incremental:
+        find += ['-newer', ARTIFACTS_STAMP]
+    if include:
+        find.append('\\(')
+        for pattern in include:
+            find += ['-path', shlex_quote(pattern), '-o']
+        find[-1] = '\\)'
+    for pattern in exclude or []:
+        find += ['!', '-path', shlex_quote(pattern)]
+
+    # Files changed since the new stamp was created are picked up by the
+    # next incremental collection. tar exits with 1 when a file changed
+    # while it was read, which is expected for logs.
+    return ' '.join(
+        [
+            '[ -e {0} ] || touch -d @0 {0};'.format(ARTIFACTS_STAMP),
+            'touch', ARTIFACTS_STAMP + '.new;'
+        ] + find + [
+            '-print0', '2>/dev/null', '|', 'tar', '--null', '-T', '-',
+            '--ignore-failed-read', '-czf', '-', '2>/dev/null;',
+            'rc=$?; [ $rc -le 1 ] && mv', ARTIFACTS_STAMP + '.new',
+            ARTIFACTS_STAMP + ' && exit 0; exit $rc'
         ]
+    )
+
+
+def _stream_command_output(vm, command, local_path, chunk_size=1 << 16):
+    with ssh_pool.get_ssh_pool().channel(vm) as channel:
+        channel.exec_command(command)
+        with open(local_path, 'wb') as dest:
+            while True:
+                data = channel.recv(chunk_size)
+                if not data:
+                    break
+                dest.write(data)
+        return channel.recv_exit_status()
+
 
-        return utils.run_interactive_command(
-            cmd, env={'ANSIBLE_HOST_KEY_CHECKING': 'False'}
+def collect_artifacts(
+    env,
+    output_dir,
+    include=None,
+    exclude=None,
+    max_size=None,
+    incremental=False,
+):
+    """
+    Collect the artifacts of all the VMs in 'env' concurrently, each VM
+    streams a single gzipped tar to '<output_dir>/<vm name>.tar.gz'.
+    'include' and 'exclude' are 'find -path' patterns, 'max_size' skips
+    files bigger than the given number of bytes and 'incremental' skips
+    files which didn't change since the previous incremental collection.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    def _collect(vm):
+        paths = vm._artifact_paths()
+        if not paths:
+            return True
+        local_path = os.path.join(output_dir, '%s.tar.gz' % vm.name())
+        code = _stream_command_output(
+            vm,
+            _artifacts_command(paths, include, exclude, max_size, incremental),
+            local_path,
+        )
+        if code != 0:
+            raise RuntimeError(
+                'collecting artifacts from %s failed (%d)' % (vm.name(), code)
+            )
+        return True
+
+    vms = list(env.get_vms().values())
+    return all(
+        run_concurrently(
+            [functools.partial(_collect, vm) for vm in vms],
+            max_workers=max(len(vms), 1)
         )
+    )
+
+
+def _sha256(path, chunk_size=1 << 16):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _crc32(path, chunk_size=1 << 16):
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc & 0xffffffff
+
+
+def _local_matches(path, sha256):
+    return os.path.isfile(path) and _sha256(path) == sha256
+
+
+def _remote_checksums(vm, remote_dir):
+    result = ssh_pool.get_ssh_pool().ssh(
+        vm, [
+            'cd', shlex_quote(remote_dir), '&&', 'find', '.', '-type', 'f',
+            '-print0', '|', 'xargs', '-0', '-r', 'sha256sum'
+        ]
+    )
+    if result.code != 0:
+        raise RuntimeError(
+            'listing %s on %s failed: %s' % (remote_dir, vm.name(), result.err)
+        )
+
+    checksums = {}
+    for line in result.out.splitlines():
+        sha256, path = line.split(None, 1)
+        checksums[os.path.normpath(path)] = sha256
+    return checksums
+
+
+def _drain_stderr(channel, chunk_size=1 << 16):
+    """
+    Reads the stderr of 'channel' in a thread, so that a command writing
+    a lot to it never stalls the stdout the caller is reading. Returns
+    the thread and the list the chunks are appended to.
+    """
+    err = []
+
+    def _drain():
+        for chunk in iter(lambda: channel.recv_stderr(chunk_size), b''):
+            err.append(chunk)
+
+    thread = threading.Thread(target=_drain)
+    thread.daemon = True
+    thread.start()
+    return thread, err
+
+
+def _contained_path(local_dir, name):
+    """
+    Returns the path the archive member 'name' is extracted to under
+    'local_dir', raising if it would end up outside of it.
+    """
+    root = os.path.realpath(local_dir)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.isabs(name) or not path.startswith(root + os.sep):
+        raise RuntimeError('unsafe archive member %s' % name)
+    return path
+
+
+def _checked_members(archive, local_dir):
+    """
+    Yields the members of 'archive', raising on any which isn't a regular
+    file or directory or which would be extracted outside 'local_dir'.
+    """
+    for member in archive:
+        if not (member.isfile() or member.isdir()):
+            raise RuntimeError('unsafe archive member %s' % member.name)
+        _contained_path(local_dir, member.name)
+        yield member
+
+
+def fetch_archive(vm, remote_dir, local_dir):
+    """
+    Fetch the tree under 'remote_dir' on 'vm' (e.g. Job.latest_art_path)
+    into 'local_dir' with a single streamed tar. Files whose local copy
+    already matches the remote sha256 are skipped and every fetched file
+    is verified against it.
+    Returns the list of the fetched relative paths.
+    """
+    checksums = _remote_checksums(vm, remote_dir)
+    missing = sorted(
+        path for path, sha256 in checksums.items()
+        if not _local_matches(os.path.join(local_dir, path), sha256)
+    )
+    if not missing:
+        return []
+
+    with ssh_pool.get_ssh_pool().channel(vm) as channel:
+        channel.exec_command(
+            'tar -C %s --null -T - -czf -' % shlex_quote(remote_dir)
+        )
+        drain, err = _drain_stderr(channel)
+        channel.sendall('\0'.join(missing).encode('utf-8'))
+        channel.shutdown_write()
+        # the data filter, where tarfile has it, rejects the same members
+        extract_kwargs = {'filter': 'data'} if hasattr(
+            tarfile, 'data_filter'
+        ) else {}
+        with tarfile.open(
+            fileobj=channel.makefile('rb'), mode='r|gz'
+        ) as archive:
+            archive.extractall(
+                local_dir,
+                members=_checked_members(archive, local_dir),
+                **extract_kwargs
+            )
+        code = channel.recv_exit_status()
+        drain.join()
+    if code != 0:
+        raise RuntimeError(
+            'fetching %s from %s failed (%d): %s' % (
+                remote_dir, vm.name(), code,
+                b''.join(err).decode('utf-8', 'replace')
+            )
+        )
+
+    corrupted = [
+        path for path in missing
+        if not _local_matches(os.path.join(local_dir, path), checksums[path])
+    ]
+    if corrupted:
+        raise AssertionError(
+            'checksum mismatch for %s' % ', '.join(corrupted)
+        )
+
+    return missing
+
+
+def fetch_archive_zip(
+    jenkins_api, job_name, local_dir, build='lastSuccessfulBuild'
+):
+    """
+    Like fetch_archive, but downloads the build's archive through the
+    Jenkins '*zip*' endpoint, which doesn't require SSH access to the
+    master. Jenkins doesn't publish checksums, so the files are verified
+    against the CRC32 of the zip entries instead.
+    Requires a client with streaming support, like
+    jenkins_client.PooledJenkins.
+    """
+    url = jenkins_api._build_url(
+        'job/%(job)s/%(build)s/artifact/*zip*/archive.zip',
+        {'job': job_name,
+         'build': build}
+    )
+    response = jenkins_api.jenkins_request(Request(url), stream=True)
+    fetched = []
+    with tempfile.TemporaryFile() as tmp:
+        for chunk in response.iter_content(1 << 16):
+            tmp.write(chunk)
+        tmp.seek(0)
+
+        with zipfile.ZipFile(tmp) as archive:
+            bad_entry = archive.testzip()
+            if bad_entry is not None:
+                raise AssertionError('CRC mismatch for %s' % bad_entry)
+            # all the entries are checked before any of them is written
+            entries = []
+            for info in archive.infolist():
+                # entries are stored under a top level 'archive/' directory
+                path = info.filename.split('/', 1)[-1]
+                if not path or path.endswith('/'):
+                    continue
+                entries.append((info, path, _contained_path(local_dir, path)))
+            for info, path, local_path in entries:
+                if os.path.isfile(local_path) and _crc32(local_path) == \
+                        info.CRC:
+                    continue
+                if not os.path.isdir(os.path.dirname(local_path)):
+                    os.makedirs(os.path.dirname(local_path))
+                with archive.open(info) as src, \
+                        open(local_path, 'wb') as dest:
+                    shutil.copyfileobj(src, dest)
+                fetched.append(path)
+
+    return sorted(fetched)
 
 
 def create_credentials_on_jenkins(jenkins_api, _uuid):
@@ -34,26 +542,38 @@ def create_credentials_on_jenkins(jenkins_api, _uuid):
     if cred_exist:
         return cred_exist
 
+    add_credentials_on_jenkins(jenkins_api, _uuid)
+
+    return has_credentials_on_jenkins(jenkins_api, _uuid)
+
+
+def add_credentials_on_jenkins(
+    jenkins_api, _uuid, username='root', password='123456', description='test'
+):
     headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-    payload = '''json={
-        "": "0",
-        "credentials": {
-            "scope": "GLOBAL",
-            "id": "%s",
-            "username": "root",
-            "password": "123456",
-            "description": "test",
-            "$class": "com.cloudbees.plugins.credentials.impl.UsernamePasswordCredentialsImpl"
+    payload = urlencode(
+        {
+            'json': json.dumps(
+                {
+                    '': '0',
+                    'credentials': {
+                        'scope': 'GLOBAL',
+                        'id': _uuid,
+                        'username': username,
+                        'password': password,
+                        'description': description,
+                        '$class': CREDENTIALS_CLASS,
+                    }
+                }
+            )
         }
-    }''' % _uuid
+    )
     url = jenkins_api._build_url(
         'credentials/store/system/domain/_/createCredentials'
     )
-    request = Request(url, payload, headers)
+    request = Request(url, payload.encode('utf-8'), headers)
     jenkins_api.jenkins_open(request)
 
-    return has_credentials_on_jenkins(jenkins_api, _uuid)
-
 
 def has_credentials_on_jenkins(jenkins_api, _uuid):
     headers = {'Content-Type': 'application/json'}
@@ -67,9 +587,8 @@ def has_credentials_on_jenkins(jenkins_api, _uuid):
         return False
 
 
-def restart_jenkins(jenkins_api):
+def restart_jenkins(jenkins_api, path='restart'):
     headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-    path = 'restart'
     url = jenkins_api._build_url(path)
     payload = '''json={}
     Submit: Yes
@@ -80,19 +599,219 @@ def restart_jenkins(jenkins_api):
     except HTTPError as e:
         if e.code != 503:
             raise
+    finally:
+        # a pooled client has to drop its session and crumb along with
+        # the old Jenkins process
+        if hasattr(jenkins_api, 'reset_session'):
+            jenkins_api.reset_session()
+
 
+INSTANCE_ID_SCRIPT = (
+    'println(java.lang.management.ManagementFactory.runtimeMXBean.startTime)'
+)
+
+
+def get_jenkins_instance_id(jenkins_api):
+    """
+    Identifies the running Jenkins process (by its JVM start time), a
+    restarted master reports a different id.
+    """
+    return jenkins_api.run_script(INSTANCE_ID_SCRIPT).strip()
+
+
+def probe_jenkins(jenkins_api, timeout=2):
+    """
+    Cheap unauthenticated check of the master's state, returns 'up',
+    'starting' (answering 503 while it loads) or 'down'.
+    """
+    try:
+        urlopen(Request(jenkins_api.server + 'login'), timeout=timeout).read()
+    except HTTPError as e:
+        return 'starting' if e.code == 503 else 'up'
+    except (URLError, socket.error, http_client.HTTPException):
+        return 'down'
+
+    return 'up'
+
+
+class RestartResult(object):
+    def __init__(self, instance_id, downtime, elapsed):
+        self.instance_id = instance_id
+        self.downtime = downtime
+        self.elapsed = elapsed
+
+
+def restart_jenkins_and_wait(
+    jenkins_api,
+    timeout=SHORT_TIMEOUT,
+    reload=False,
+    connect_timeout=2,
+    policy=None,
+):
+    """
+    Restart Jenkins, or only reload its configuration from disk when
+    'reload' is set, and wait until the new instance answers.
+    Unlike a plain restart_jenkins followed by wait_until_jenkins_is_available
+    this can't mistake the old process, before it went down, for the new one.
+    """
+    previous = None if reload else get_jenkins_instance_id(jenkins_api)
+    start = _wait_engine.clock()
+    restart_jenkins(jenkins_api, 'reload' if reload else 'restart')
+    probe = functools.partial(probe_jenkins, jenkins_api, connect_timeout)
+
+    def _went_down(state):
+        if state != 'up':
+            return True
+        # a quick restart may complete between two probes
+        return get_jenkins_instance_id(jenkins_api) != previous
+
+    if reload:
+        # Jenkins answers the reload request only once it shows its
+        # loading page, so from here on it's either loading or reloaded
+        # and it's only waited for to answer again
+        down_at = _wait_engine.clock()
+    else:
+        down = _wait_engine.wait(
+            probe,
+            timeout,
+            until=_went_down,
+            allowed_exceptions=[jenkins.JenkinsException],
+            policy=policy
+        )
+        if not down.done:
+            raise AssertionError(
+                'Jenkins did not restart within %s seconds' % timeout
+            )
+        down_at = _wait_engine.clock()
 
-def wait_until_jenkins_is_available(jenkins_api):
+    wait_until_jenkins_is_available(
+        jenkins_api,
+        previous_instance=previous,
+        timeout=max(0, timeout - (_wait_engine.clock() - start)),
+        connect_timeout=connect_timeout,
+        policy=policy
+    )
+    up_at = _wait_engine.clock()
+
+    return RestartResult(
+        get_jenkins_instance_id(jenkins_api), up_at - down_at, up_at - start
+    )
+
+
+def wait_until_jenkins_is_available(
+    jenkins_api,
+    previous_instance=None,
+    timeout=SHORT_TIMEOUT,
+    connect_timeout=2,
+    policy=None,
+):
     def _is_jenkins_available():
+        if probe_jenkins(jenkins_api, connect_timeout) != 'up':
+            return False
         jenkins_api.get_version()
+        if previous_instance is not None:
+            return get_jenkins_instance_id(jenkins_api) != previous_instance
         return True
 
-    assert_true_within_short(
+    assert_true_within(
         _is_jenkins_available,
+        timeout,
         allowed_exceptions=[
             jenkins.BadHTTPException, jenkins.JenkinsException,
             jenkins.TimeoutException, socket.error, URLError
-        ]
+        ],
+        policy=policy
+    )
+
+
+NODES_TREE = (
+    'computer[displayName,offline,temporarilyOffline,idle,numExecutors,'
+    'assignedLabels[name]]'
+)
+
+
+class NodesSnapshot(dict):
+    """
+    State of all the computers known to Jenkins, as returned by a single
+    'computer/api/json' request, indexed by node name.
+    """
+
+    def online(self, name):
+        return name in self and not self[name]['offline']
+
+    def offline_nodes(self, names):
+        return [name for name in names if not self.online(name)]
+
+    def labels(self, name):
+        # every node also carries a label of its own name
+        return sorted(
+            assigned['name']
+            for assigned in self[name].get('assignedLabels', [])
+            if assigned['name'] != name
+        )
+
+    def with_label(self, label):
+        return sorted(
+            name for name, info in self.items()
+            if label in [
+                assigned['name']
+                for assigned in info.get('assignedLabels', [])
+            ]
+        )
+
+
+def get_nodes(jenkins_api):
+    url = jenkins_api._build_url(
+        'computer/api/json?tree=%(tree)s', {'tree': NODES_TREE}
+    )
+    response = jenkins_api.jenkins_open(Request(url))
+
+    return NodesSnapshot(
+        (computer['displayName'], computer)
+        for computer in json.loads(response)['computer']
+    )
+
+
+def assert_nodes_online_within(
+    jenkins_api,
+    names,
+    timeout,
+    allowed_exceptions=None,
+    policy=None,
+    events=None,
+):
+    start = _wait_engine.clock()
+    online_after = {}
+
+    def _all_online(snapshot):
+        for name in names:
+            if name not in online_after and snapshot.online(name):
+                online_after[name] = _wait_engine.clock() - start
+        return len(online_after) == len(names)
+
+    result = _wait_engine.wait(
+        functools.partial(get_nodes, jenkins_api),
+        timeout,
+        until=_all_online,
+        allowed_exceptions=allowed_exceptions,
+        policy=policy,
+        wakeup=events.node_waiter(names) if events else None
+    )
+    if not result.done:
+        snapshot = result.value if result.returned else NodesSnapshot()
+        raise AssertionError(
+            'nodes not online after %s seconds: %s' %
+            (timeout, ', '.join(snapshot.offline_nodes(names)))
+        )
+
+    return online_after
+
+
+def assert_nodes_online_within_short(
+    jenkins_api, names, allowed_exceptions=None, policy=None, events=None
+):
+    return assert_nodes_online_within(
+        jenkins_api, names, SHORT_TIMEOUT, allowed_exceptions, policy, events
     )
 
 
@@ -100,79 +819,479 @@ def _instance_of_any(obj, cls_list):
     return any(True for cls in cls_list if isinstance(obj, cls))
 
 
-def allow_exceptions_within_timeout(func, timeout, allowed_exceptions=None):
-    allowed_exceptions = allowed_exceptions or [Exception]
-    with utils.EggTimer(timeout=timeout) as timer:
-        while not timer.elapsed():
+class WaitPolicy(object):
+    """
+    Polling cadence of a wait: a fast first poll followed by an
+    exponential backoff with jitter, capped at 'max_delay' seconds.
+    """
+
+    def __init__(self, first_delay=0.05, factor=2, max_delay=3, jitter=0.2):
+        self.first_delay = first_delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delays(self):
+        delay = self.first_delay
+        while True:
+            spread = delay * self.jitter
+            yield max(0, delay + random.uniform(-spread, spread))
+            delay = min(delay * self.factor, self.max_delay)
+
+
+DEFAULT_POLICY = WaitPolicy()
+
+
+class WaitResult(object):
+    def __init__(self):
+        self.done = False
+        self.value = None
+        self.returned = False
+        self.exception = None
+        self.polls = 0
+        self.elapsed = 0
+        self.slept = 0
+        self.cancelled = False
+
+
+class WaitEngine(object):
+    """
+    Calls 'func' until 'until(result)' holds or 'timeout' seconds passed.
+    Exceptions which are instances of 'allowed_exceptions' are recorded
+    and retried, any other exception is propagated.
+    Between polls 'wakeup(delay)' is called, it defaults to sleeping and
+    may return early, e.g. once an event the wait depends on arrived.
+    Once the threading.Event 'cancel' is set the wait gives up before its
+    next poll, as not done.
+    The clock and sleep functions can be replaced, e.g. for tests.
+    """
+
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+
+    def wait(
+        self,
+        func,
+        timeout,
+        until=None,
+        allowed_exceptions=None,
+        policy=None,
+        wakeup=None,
+        cancel=None,
+    ):
+        until = until or (lambda _: True)
+        if wakeup is None and cancel is not None and self.sleep is time.sleep:
+            # a real sleep ends as soon as the wait is cancelled
+            wakeup = cancel.wait
+        wakeup = wakeup or self.sleep
+        allowed_exceptions = allowed_exceptions or []
+        policy = policy or DEFAULT_POLICY
+        result = WaitResult()
+        start = self.clock()
+        deadline = start + timeout
+        delays = policy.delays()
+
+        while True:
+            if cancel is not None and cancel.is_set():
+                result.cancelled = True
+                break
+            result.polls += 1
             try:
-                return func()
+                result.value = func()
+                result.returned = True
+                result.exception = None
+                if until(result.value):
+                    result.done = True
+                    break
             except Exception as exc:
                 if not _instance_of_any(exc, allowed_exceptions):
                     raise
+                result.exception = exc
+
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                break
+            delay = min(next(delays), remaining)
+            slept_since = self.clock()
+            wakeup(delay)
+            result.slept += self.clock() - slept_since
 
-            time.sleep(3)
+        result.elapsed = self.clock() - start
+        return result
 
 
-def allow_exceptions_within_short(func, allowed_exceptions=None):
+_wait_engine = WaitEngine()
+
+
+def get_wait_engine():
+    return _wait_engine
+
+
+def set_wait_engine(engine):
+    global _wait_engine
+    _wait_engine = engine
+
+
+def allow_exceptions_within_timeout(
+    func, timeout, allowed_exceptions=None, policy=None
+):
+    result = _wait_engine.wait(
+        func,
+        timeout,
+        allowed_exceptions=allowed_exceptions or [Exception],
+        policy=policy
+    )
+
+    return result.value if result.done else None
+
+
+def allow_exceptions_within_short(func, allowed_exceptions=None, policy=None):
     return allow_exceptions_within_timeout(
-        func, SHORT_TIMEOUT, allowed_exceptions
+        func, SHORT_TIMEOUT, allowed_exceptions, policy
     )
 
 
-def allow_exceptions_within_long(func, allowed_exceptions=None):
+def allow_exceptions_within_long(func, allowed_exceptions=None, policy=None):
     return allow_exceptions_within_timeout(
-        func, LONG_TIMEOUT, allowed_exceptions
+        func, LONG_TIMEOUT, allowed_exceptions, policy
     )
 
 
-def assert_equals_within(func, value, timeout, allowed_exceptions=None):
-    allowed_exceptions = allowed_exceptions or []
-    with utils.EggTimer(timeout) as timer:
-        while not timer.elapsed():
-            try:
-                res = func()
-                if res == value:
-                    return
-            except Exception as exc:
-                if _instance_of_any(exc, allowed_exceptions):
-                    continue
-                raise
+def assert_equals_within(
+    func, value, timeout, allowed_exceptions=None, policy=None
+):
+    result = _wait_engine.wait(
+        func,
+        timeout,
+        until=lambda res: res == value,
+        allowed_exceptions=allowed_exceptions,
+        policy=policy
+    )
+    if result.done:
+        return
 
-            time.sleep(3)
-    try:
-        raise AssertionError(
-            '%s != %s after %s seconds' % (res, value, timeout)
-        )
-    # if func repeatedly raises any of the allowed exceptions, res remains
-    # unbound throughout the function, resulting in an UnboundLocalError.
-    except UnboundLocalError:
+    # if func repeatedly raises any of the allowed exceptions, there is
+    # no value to report.
+    if not result.returned:
         raise AssertionError(
             '%s failed to evaluate after %s seconds' %
             (func.__name__, timeout)
         )
+    raise AssertionError(
+        '%s != %s after %s seconds' % (result.value, value, timeout)
+    )
 
 
-def assert_equals_within_short(func, value, allowed_exceptions=None):
-    allowed_exceptions = allowed_exceptions or []
+def assert_equals_within_short(
+    func, value, allowed_exceptions=None, policy=None
+):
     assert_equals_within(
-        func, value, SHORT_TIMEOUT, allowed_exceptions=allowed_exceptions
+        func,
+        value,
+        SHORT_TIMEOUT,
+        allowed_exceptions=allowed_exceptions,
+        policy=policy
     )
 
 
-def assert_equals_within_long(func, value, allowed_exceptions=None):
-    allowed_exceptions = allowed_exceptions or []
+def assert_equals_within_long(
+    func, value, allowed_exceptions=None, policy=None
+):
     assert_equals_within(
-        func, value, LONG_TIMEOUT, allowed_exceptions=allowed_exceptions
+        func,
+        value,
+        LONG_TIMEOUT,
+        allowed_exceptions=allowed_exceptions,
+        policy=policy
+    )
+
+
+def assert_true_within(func, timeout, allowed_exceptions=None, policy=None):
+    assert_equals_within(func, True, timeout, allowed_exceptions, policy)
+
+
+def assert_true_within_short(func, allowed_exceptions=None, policy=None):
+    assert_equals_within_short(func, True, allowed_exceptions, policy)
+
+
+def assert_true_within_long(func, allowed_exceptions=None, policy=None):
+    assert_equals_within_long(func, True, allowed_exceptions, policy)
+
+
+def wait_for_all(
+    conditions,
+    timeout,
+    until=None,
+    allowed_exceptions=None,
+    policy=None,
+    max_workers=10,
+):
+    """
+    Wait on all the named callables in 'conditions' concurrently, using at
+    most 'max_workers' threads and one deadline shared by all of them.
+    Returns a dict of name -> (WaitResult, seconds until it finished).
+    An exception which isn't allowed cancels the other waits and is
+    raised as soon as they stopped.
+    """
+    engine = _wait_engine
+    start = engine.clock()
+    deadline = start + timeout
+    names = list(conditions)
+    failed = threading.Event()
+
+    def _wait(name):
+        try:
+            result = engine.wait(
+                conditions[name],
+                max(0, deadline - engine.clock()),
+                until=until,
+                allowed_exceptions=allowed_exceptions,
+                policy=policy,
+                cancel=failed,
+            )
+        except Exception:
+            failed.set()
+            raise
+        return result, engine.clock() - start
+
+    return dict(
+        zip(
+            names,
+            run_concurrently(
+                [functools.partial(_wait, name) for name in names],
+                max_workers
+            )
+        )
     )
 
 
-def assert_true_within(func, timeout, allowed_exceptions=None):
-    assert_equals_within(func, True, timeout, allowed_exceptions)
+def run_concurrently(funcs, max_workers=10):
+    """
+    Call all of 'funcs' using at most 'max_workers' threads and return
+    their results in the same order. If any of them raised, the first
+    exception is raised once all of them finished.
+    """
+    pending = queue.Queue()
+    for index, func in enumerate(funcs):
+        pending.put((index, func))
+    results = [None] * len(funcs)
+    errors = []
+
+    def _worker():
+        while True:
+            try:
+                index, func = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = func()
+            except Exception as exc:
+                errors.append(exc)
+
+    workers = [
+        threading.Thread(target=_worker)
+        for _ in range(min(max_workers, len(funcs)))
+    ]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        raise errors[0]
 
+    return results
+
+
+def assert_all_equal_within(
+    conditions, value, timeout, allowed_exceptions=None, policy=None
+):
+    results = wait_for_all(
+        conditions,
+        timeout,
+        until=lambda res: res == value,
+        allowed_exceptions=allowed_exceptions,
+        policy=policy
+    )
+    laggards = []
+    for name, (result, _) in sorted(results.items()):
+        if result.done:
+            continue
+        if result.returned:
+            laggards.append('%s: %s != %s' % (name, result.value, value))
+        else:
+            laggards.append(
+                '%s: failed to evaluate (%r)' % (name, result.exception)
+            )
+    if laggards:
+        raise AssertionError(
+            '%d of %d conditions not met after %s seconds:\n%s' % (
+                len(laggards), len(conditions), timeout, '\n'.join(laggards)
+            )
+        )
+
+    return dict(
+        (name, finished_at) for name, (_, finished_at) in results.items()
+    )
+
+
+def assert_all_true_within(
+    conditions, timeout, allowed_exceptions=None, policy=None
+):
+    return assert_all_equal_within(
+        conditions, True, timeout, allowed_exceptions, policy
+    )
+
+
+def assert_all_true_within_short(
+    conditions, allowed_exceptions=None, policy=None
+):
+    return assert_all_true_within(
+        conditions, SHORT_TIMEOUT, allowed_exceptions, policy
+    )
+
+
+def assert_all_true_within_long(
+    conditions, allowed_exceptions=None, policy=None
+):
+    return assert_all_true_within(
+        conditions, LONG_TIMEOUT, allowed_exceptions, policy
+    )
+
+
+class TrackedBuild(object):
+    def __init__(self, job, queue_id, triggered_at):
+        self.job = job
+        self.queue_id = queue_id
+        self.triggered_at = triggered_at
+        self.number = None
+        self.built_on = None
+        self.result = None
+        self.queued_since = None
+        self.timestamp = None
+        self.started_at = None
+        self.finished_at = None
+        self.duration = None
+
+    @property
+    def started(self):
+        return self.started_at is not None
+
+    @property
+    def finished(self):
+        return self.result is not None
+
+    @property
+    def queue_wait(self):
+        if self.timestamp is None or self.queued_since is None:
+            return None
+        return (self.timestamp - self.queued_since) / 1000.0
+
+    @property
+    def start_latency(self):
+        if self.started_at is None:
+            return None
+        return self.started_at - self.triggered_at
+
+    def __repr__(self):
+        return '<%s #%s (queue item %s): %s>' % (
+            self.job, self.number, self.queue_id, self.result or
+            ('RUNNING' if self.started else 'QUEUED')
+        )
+
+
+class BuildTracker(object):
+    """
+    Follows builds from the queue item returned by build_job to their
+    build number and then to completion. All the tracked builds share a
+    single poll loop.
+    Requires a client whose build_job returns the queue item id, like
+    jenkins_client.PooledJenkins. If an events.EventListener is given, the
+    loop polls again as soon as an event for one of the jobs arrives. If a
+    console.ConsoleStreamer is given, it follows every triggered build.
+    """
+
+    def __init__(self, jenkins_api, events=None, console=None):
+        self.jenkins_api = jenkins_api
+        self.events = events
+        self.console = console
+        self.builds = []
+
+    def trigger(self, job, parameters=None):
+        queue_id = self.jenkins_api.build_job(job, parameters)
+        if queue_id is None:
+            raise AssertionError('No queue item was created for %s' % job)
+        build = TrackedBuild(job, queue_id, _wait_engine.clock())
+        self.builds.append(build)
+        if self.console is not None:
+            self.console.follow(build)
+
+        return build
+
+    def _update(self, build):
+        if build.number is None:
+            item = self.jenkins_api.get_queue_item(build.queue_id)
+            build.queued_since = item.get('inQueueSince')
+            if item.get('cancelled'):
+                build.result = 'CANCELLED'
+                build.finished_at = _wait_engine.clock()
+                return
+            if not item.get('executable'):
+                return
+            build.number = item['executable']['number']
+
+        info = self.jenkins_api.get_build_info(build.job, build.number)
+        if build.started_at is None:
+            build.started_at = _wait_engine.clock()
+            build.timestamp = info['timestamp']
+            build.built_on = info['builtOn']
+        if not info['building'] and info['result'] is not None:
+            build.result = info['result']
+            build.duration = info['duration'] / 1000.0
+            build.finished_at = _wait_engine.clock()
+
+    def poll(self, until='finished'):
+        pending = [
+            build for build in self.builds if not getattr(build, until)
+        ]
+        for build in pending:
+            self._update(build)
+
+        return [build for build in pending if not getattr(build, until)]
+
+    def wait(
+        self,
+        timeout,
+        until='finished',
+        allowed_exceptions=None,
+        policy=None,
+    ):
+        if allowed_exceptions is None:
+            allowed_exceptions = [jenkins.NotFoundException]
+        result = _wait_engine.wait(
+            functools.partial(self.poll, until),
+            timeout,
+            until=lambda pending: not pending,
+            allowed_exceptions=allowed_exceptions,
+            policy=policy,
+            wakeup=self.events.build_waiter(
+                set(build.job for build in self.builds)
+            ) if self.events else None
+        )
+        if not result.done:
+            raise AssertionError(
+                'builds not %s after %s seconds: %s' % (
+                    until, timeout, result.value
+                    if result.returned else result.exception
+                )
+            )
 
-def assert_true_within_short(func, allowed_exceptions=None):
-    assert_equals_within_short(func, True, allowed_exceptions)
+        return self.builds
 
+    def wait_within_short(self, until='finished', policy=None):
+        return self.wait(SHORT_TIMEOUT, until, policy=policy)
 
-def assert_true_within_long(func, allowed_exceptions=None):
-    assert_equals_within_long(func, True, allowed_exceptions)
+    def wait_within_long(self, until='finished', policy=None):
+        return self.wait(LONG_TIMEOUT, until, policy=policy)
@@ -0,0 +1,263 @@
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import jenkins_client
+import testlib
+
+Span = collections.namedtuple(
+    'Span', ['name', 'cat', 'module', 'start', 'duration', 'tid', 'args']
+)
+
+# Frames of these files are skipped when looking for who started a wait
+_INTERNAL_FILES = [
+    os.path.splitext(os.path.abspath(module.__file__))[0]
+    for module in (testlib, sys.modules[__name__])
+]
+
+
+def _name(func):
+    func = getattr(func, 'func', func)
+    return getattr(func, '__name__', repr(func))
+
+
+def _caller():
+    frame = sys._getframe(1)
+    while frame is not None:
+        path = os.path.splitext(os.path.abspath(frame.f_code.co_filename))[0]
+        if path not in _INTERNAL_FILES:
+            return '%s:%s %s' % (
+                os.path.basename(frame.f_code.co_filename), frame.f_lineno,
+                frame.f_code.co_name
+            )
+        frame = frame.f_back
+    return None
+
+
+class Recorder(object):
+    """
+    Thread safe list of timed spans. Spans are attributed to the test
+    module which was running when they were recorded.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.module = None
+        self._lock = threading.Lock()
+
+    def add(self, name, cat, start, duration, **args):
+        span = Span(
+            name, cat, self.module, start, duration,
+            threading.current_thread().ident, args
+        )
+        with self._lock:
+            self.spans.append(span)
+
+    def slowest(self, count, cat=None):
+        with self._lock:
+            spans = [
+                span for span in self.spans if cat is None or span.cat == cat
+            ]
+        return sorted(spans, key=lambda span: -span.duration)[:count]
+
+    def module_spans(self, module):
+        with self._lock:
+            return [span for span in self.spans if span.module == module]
+
+
+_recorder = None
+
+
+def get_recorder():
+    return _recorder
+
+
+def record_metric(name, value, **args):
+    """
+    Records a named measurement, e.g. the queue wait of a build, which is
+    kept in the run's timings and tracked by the baselines store. Does
+    nothing outside a session with the timing plugin.
+    """
+    if _recorder is not None and value is not None:
+        _recorder.add(name, 'metric', time.time(), value, **args)
+
+
+@contextlib.contextmanager
+def metric(name, **args):
+    """
+    Records how long the block took as the metric 'name', if it didn't
+    raise.
+    """
+    start = time.time()
+    yield
+    record_metric(name, time.time() - start, **args)
+
+
+class TimedWaitEngine(testlib.WaitEngine):
+    """
+    A WaitEngine which records every wait, its polls and how much of it
+    was spent sleeping rather than polling.
+    """
+
+    def __init__(self, recorder, clock=time.time, sleep=time.sleep):
+        super(TimedWaitEngine, self).__init__(clock, sleep)
+        self.recorder = recorder
+
+    def wait(self, func, timeout, *args, **kwargs):
+        start = time.time()
+        result = None
+        try:
+            result = super(TimedWaitEngine, self).wait(
+                func, timeout, *args, **kwargs
+            )
+            return result
+        finally:
+            duration = time.time() - start
+            args = {'timeout': timeout, 'caller': _caller()}
+            if result is None:
+                args['error'] = True
+            else:
+                args.update(
+                    done=result.done,
+                    polls=result.polls,
+                    slept=result.slept,
+                    working=result.elapsed - result.slept,
+                )
+            self.recorder.add(_name(func), 'wait', start, duration, **args)
+
+
+def write_json(spans, path):
+    with open(path, mode='wt') as f:
+        json.dump([span._asdict() for span in spans], f, indent=4)
+
+
+def write_chrome_trace(spans, path):
+    """
+    Writes 'spans' in the Trace Event Format, which chrome://tracing and
+    Perfetto load.
+    """
+    events = [
+        {
+            'name': span.name,
+            'cat': span.cat,
+            'ph': 'X',
+            'ts': int(span.start * 1e6),
+            'dur': int(span.duration * 1e6),
+            'pid': os.getpid(),
+            'tid': span.tid,
+            'args': span.args,
+        } for span in spans
+    ]
+    with open(path, mode='wt') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class TimingPlugin(object):
+    """
+    Records spans for fixture setups, test phases, testlib waits and
+    Jenkins requests. At the end of the session they are written to
+    'timings.json' and 'timings.trace.json' under the module_results_path
+    of every module, and the slowest ones are summarized.
+    """
+
+    def __init__(self, top=10):
+        self.top = top
+        self.recorder = Recorder()
+        self._results_paths = {}
+        self._wait_engine = None
+
+    def _on_request(self, method, url, status, start, duration):
+        self.recorder.add(
+            '%s %s' % (method, url.split('?', 1)[0]),
+            'http',
+            start,
+            duration,
+            status=status,
+            url=url,
+        )
+
+    def pytest_sessionstart(self, session):
+        global _recorder
+        _recorder = self.recorder
+        self._wait_engine = testlib.get_wait_engine()
+        testlib.set_wait_engine(
+            TimedWaitEngine(
+                self.recorder, self._wait_engine.clock,
+                self._wait_engine.sleep
+            )
+        )
+        jenkins_client.add_request_hook(self._on_request)
+
+    def pytest_sessionfinish(self, session):
+        global _recorder
+        _recorder = None
+        jenkins_client.remove_request_hook(self._on_request)
+        testlib.set_wait_engine(self._wait_engine)
+        for module, results_path in self._results_paths.items():
+            spans = self.recorder.module_spans(module)
+            if not os.path.isdir(results_path):
+                continue
+            write_json(spans, os.path.join(results_path, 'timings.json'))
+            write_chrome_trace(
+                spans, os.path.join(results_path, 'timings.trace.json')
+            )
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_fixture_setup(self, fixturedef, request):
+        start = time.time()
+        outcome = yield
+        self.recorder.add(
+            fixturedef.argname,
+            'fixture',
+            start,
+            time.time() - start,
+            scope=fixturedef.scope,
+        )
+        if fixturedef.argname == 'module_results_path' and \
+                outcome.excinfo is None:
+            self._results_paths[request.module.__name__] = \
+                outcome.get_result()
+
+    def _phase(self, item, phase):
+        self.recorder.module = item.module.__name__
+        return '%s %s' % (item.nodeid, phase)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_setup(self, item):
+        name, start = self._phase(item, 'setup'), time.time()
+        yield
+        self.recorder.add(name, 'test', start, time.time() - start)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_call(self, item):
+        name, start = self._phase(item, 'call'), time.time()
+        yield
+        self.recorder.add(name, 'test', start, time.time() - start)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_teardown(self, item):
+        name, start = self._phase(item, 'teardown'), time.time()
+        yield
+        self.recorder.add(name, 'test', start, time.time() - start)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.top:
+            return
+
+        terminalreporter.section('slowest %d spans' % self.top)
+        for span in self.recorder.slowest(self.top):
+            details = ''
+            if span.cat == 'wait' and 'polls' in span.args:
+                details = ' (%d polls, %.2fs sleeping)' % (
+                    span.args['polls'], span.args['slept']
+                )
+            terminalreporter.write_line(
+                '%8.2fs %-8s %s%s' %
+                (span.duration, span.cat, span.name, details)
+            )
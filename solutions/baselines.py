@@ -0,0 +1 @@
+../jenkins-system-tests/baselines.py
\ No newline at end of file
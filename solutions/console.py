@@ -0,0 +1 @@
+../jenkins-system-tests/console.py
\ No newline at end of file
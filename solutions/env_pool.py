@@ -0,0 +1 @@
+../jenkins-system-tests/env_pool.py
\ No newline at end of file
@@ -0,0 +1 @@
+../jenkins-system-tests/events.py
\ No newline at end of file
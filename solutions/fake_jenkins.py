@@ -0,0 +1 @@
+../jenkins-system-tests/fake_jenkins.py
\ No newline at end of file
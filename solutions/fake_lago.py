@@ -0,0 +1 @@
+../jenkins-system-tests/fake_lago.py
\ No newline at end of file
@@ -0,0 +1 @@
+../jenkins-system-tests/jenkins_client.py
\ No newline at end of file
@@ -0,0 +1 @@
+../jenkins-system-tests/job_factory.py
\ No newline at end of file
@@ -0,0 +1 @@
+../jenkins-system-tests/loadgen.py
\ No newline at end of file
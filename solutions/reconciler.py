@@ -0,0 +1 @@
+../jenkins-system-tests/reconciler.py
\ No newline at end of file
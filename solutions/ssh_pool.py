@@ -0,0 +1 @@
+../jenkins-system-tests/ssh_pool.py
\ No newline at end of file
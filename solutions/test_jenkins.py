@@ -1,12 +1,18 @@
 import pytest
 import jenkins
-import lago.utils
-from lago.workdir import PrefixAlreadyExists
-from lago import sdk
+# Lago's, or its stand-in when Lago isn't installed
+from fake_lago import PrefixAlreadyExists
 import os
 import testlib
+import jenkins_client
+import events
+import reconciler
+import job_factory
+import loadgen
+import console
+import ssh_pool
+import timings
 import functools
-import scp
 import logging
 '''
 
@@ -17,20 +23,18 @@ In order to run this tests cd into jenkins-system-tests and run:
 
 
 @pytest.fixture(scope='class')
-def env(cls_results_path):
-    config = 'init-jenkins.yaml'
-    workdir = '/tmp/lago-workdir'
-
+def env(cls_results_path, env_lease, lago_sdk):
     try:
-        lago_env = sdk.init(
-            config=config,
-            workdir=workdir,
+        lago_env = lago_sdk.init(
+            config=env_lease.config,
+            workdir=env_lease.workdir,
+            prefix_name=env_lease.prefix_name,
             logfile=os.path.join(cls_results_path, 'lago.log'),
             loglevel=logging.DEBUG
         )
     except PrefixAlreadyExists:
-        lago_env = sdk.load_env(
-            workdir=workdir,
+        lago_env = lago_sdk.load_env(
+            workdir=env_lease.workdir,
             logfile=os.path.join(cls_results_path, 'lago.log'),
             loglevel=logging.DEBUG
         )
@@ -41,7 +45,7 @@ def env(cls_results_path):
     # Task: Add log collection. The logs should be collected to a
     # sub directory of 'cls_result_path
     collect_path = os.path.join(cls_results_path, 'collect')
-    lago_env.collect_artifacts(output_dir=collect_path, ignore_nopath=True)
+    testlib.collect_artifacts(lago_env, collect_path)
     # EndTask
 
 
@@ -51,9 +55,17 @@ def jenkins_master(env):
     return vms['jenkins-master']
 
 
+@pytest.fixture(scope='class')
+def deployment(env, env_lease):
+    deployment = testlib.Deployment(env, 'init-jenkins.yaml', 'ansible')
+    # a pooled env is leased after it was reverted to its deployment
+    deployment.restored = env_lease.snapshot == deployment.snapshot_name
+    return deployment
+
+
 @pytest.fixture(scope='module')
-def jenkins_info():
-    return {'port': 8080, 'username': 'admin', 'password': 'admin'}
+def jenkins_info(jenkins_port):
+    return {'port': jenkins_port, 'username': 'admin', 'password': 'admin'}
 
 
 class Job:
@@ -71,17 +83,29 @@ class Job:
 
 class TestDeployJenkins(object):
     @pytest.mark.lab_2
-    def test_deploy_with_ansible(self, env, jenkins_master):
+    @pytest.mark.needs_vms
+    def test_deploy_with_ansible(
+        self, env, jenkins_master, deployment, cls_results_path
+    ):
         # Task: verify that jenkins_master is reachable through ssh
-        jenkins_master.ssh_reachable(tries=100)
+        # Hint: ssh_pool.get_ssh_pool() keeps a live session per VM
+        ssh_pool.get_ssh_pool().wait_for_ssh(jenkins_master, tries=100)
         # EndTask
-        result = testlib.deploy_ansible_playbook(
-            env, 'ansible/jenkins_playbook.yaml'
-        )
+        if deployment.restore():
+            return
+
+        with timings.metric('deploy'):
+            result = testlib.deploy_ansible_playbook(
+                env,
+                'ansible/jenkins_playbook.yaml',
+                results_path=cls_results_path
+            )
         if result:
             print result.err
             raise AssertionError
 
+        deployment.save()
+
 
 class TestJenkins(object):
     @pytest.fixture(scope='class')
@@ -113,22 +137,40 @@ class TestJenkins(object):
 
     @pytest.fixture(scope='class')
     def cred_uuid(self, jenkins_api):
-        return testlib.create_credentials_on_jenkins(
-            jenkins_api, '5fa49f22-298f-4894-b4b0-b2b5d812f5e0'
-        )
+        _uuid = '5fa49f22-298f-4894-b4b0-b2b5d812f5e0'
+        reconciler.reconcile(jenkins_api, {'credentials': {_uuid: {}}})
+
+        return _uuid
 
     @pytest.fixture('class')
     def jenkins_api(self, jenkins_info, jenkins_master):
         # Task: Get jenkins master ip and assign it to a variable called jenkins_master_ip
         jenkins_master_ip = jenkins_master.ip()
         # EndTask
-        return jenkins.Jenkins(
+        client = jenkins_client.CachingJenkins(
             'http://{ip}:{port}'.format(
                 ip=jenkins_master_ip, port=jenkins_info['port']
             ),
             username=jenkins_info['username'],
             password=jenkins_info['password']
         )
+        yield client
+        client.close()
+
+    @pytest.fixture(scope='class')
+    def jenkins_events(self, jenkins_api, event_listener):
+        if event_listener is None:
+            return None
+
+        events.install_event_hooks(jenkins_api, event_listener.url)
+        return event_listener
+
+    @pytest.fixture(scope='function')
+    def console_log(self, jenkins_api, func_results_path):
+        streamer = console.ConsoleStreamer(jenkins_api, func_results_path)
+        streamer.start()
+        yield streamer
+        streamer.stop()
 
     @pytest.mark.lab_3
     def test_basic_api_connection(
@@ -167,52 +209,20 @@ class TestJenkins(object):
             assert plugin in installed_plugins
 
     @pytest.mark.lab_4
-    def test_add_slaves(self, jenkins_api, env, cred_uuid):
-        def add_slave(hostname, label):
-            if jenkins_api.node_exists(hostname):
-                return True
-
-            params = {
-                'port': '22',
-                'username': 'root',
-                'host': hostname,
-                'credentialsId': cred_uuid,
-            }
-
-            jenkins_api.create_node(
-                hostname,
-                nodeDescription='test slave',
-                labels=label,
-                numExecutors=1,
-                exclusive=True,
-                launcher=jenkins.LAUNCHER_SSH,
-                launcher_params=params
-            )
-
-            return True
-
-        # Task: Create a list of tuples where each tuple contains
-        # a vm name and it's jenkins label, for example (vm-0, dev)
-        # Recall that only vms in group 'jenkins-slaves' has a label
-        slaves_and_labels = [
-            (vm.name(), vm.metadata.get('jenkins-label'))
-            for vm in env.get_vms().viewvalues()
-            if 'jenkins-slaves' in vm.groups
-        ]
+    def test_add_slaves(self, jenkins_api, env, cred_uuid, jenkins_events):
+        # Task: Create the node specs of all the vms in group
+        # 'jenkins-slaves', each labeled by its 'jenkins-label' metadata
+        # Hint: reconciler.ssh_nodes_from_env does it for a whole env
+        nodes = reconciler.ssh_nodes_from_env(env, cred_uuid)
         # EndTask
 
-        vec = lago.utils.func_vector(add_slave, slaves_and_labels)
-        vt = lago.utils.VectorThread(vec)
-        vt.start_all()
-        assert all(vt.join_all())
+        reconciler.reconcile(jenkins_api, {'nodes': nodes})
 
-        for slave, _ in slaves_and_labels:
-            testlib.assert_true_within_short(
-                functools.partial(jenkins_api.node_exists, slave)
-            )
-            testlib.assert_true_within_short(
-                lambda: not jenkins_api.get_node_info(slave)['offline']
-            )
+        online = testlib.assert_nodes_online_within_short(
+            jenkins_api, list(nodes), events=jenkins_events
+        )
+        if online:
+            timings.record_metric('nodes_online', max(online.values()))
 
     @pytest.mark.lab_5
     def test_throw_exception_on_undefined_job(self, jenkins_api):
@@ -225,64 +235,51 @@ class TestJenkins(object):
 
     @pytest.mark.lab_5
     def test_create_labled_job(self, jenkins_api, dev_job):
-        if jenkins_api.job_exists(dev_job.name):
-            return True
-
-        with open(dev_job.xml_path, mode='rt') as f:
-            job_xml = f.read()
-
-        jenkins_api.create_job(dev_job.name, job_xml)
+        factory = job_factory.JobFactory(jenkins_api)
+        factory.add(dev_job.name, dev_job.xml_path, label=dev_job.label)
+        factory.apply()
 
         assert jenkins_api.job_exists(dev_job.name)
 
     @pytest.mark.lab_5
-    def test_trigger_labeled_job(self, jenkins_api, env, dev_job):
-        labeled_nodes = [
-            vm.name() for vm in env.get_vms().viewvalues()
-            if vm.metadata.get('jenkins-label') == dev_job.label
-        ]
-        dev_job_info = jenkins_api.get_job_info(dev_job.name)
-        next_build_number = dev_job_info['nextBuildNumber']
-        jenkins_api.build_job(dev_job.name)
-
-        def assert_job_run_on_labeled_slave(
-            job, build_number, optional_slaves
-        ):
-            build_info = jenkins_api.get_build_info(job, build_number)
-            assert build_info['builtOn'] in optional_slaves
-
-        allowed_exceptions = [jenkins.NotFoundException]
-
-        # Task: invoke 'assert_job_run_on_labeled_slave' and allow
-        # it to throw exceptions within a short timeout.
-        # The allowed exceptions are the ones who are in 'allowed exceptions'
-        # Hint: Use functools.partial
-        testlib.allow_exceptions_within_short(
-            functools.partial(
-                assert_job_run_on_labeled_slave, dev_job.name,
-                next_build_number, labeled_nodes
-            ), allowed_exceptions=allowed_exceptions
+    def test_trigger_labeled_job(
+        self, jenkins_api, env, dev_job, jenkins_events, console_log
+    ):
+        labeled_nodes = testlib.get_nodes(jenkins_api).with_label(
+            dev_job.label
         )
+        tracker = testlib.BuildTracker(
+            jenkins_api, events=jenkins_events, console=console_log
+        )
+        build = tracker.trigger(dev_job.name)
+
+        # Task: wait for 'build' to finish within a short timeout using
+        # 'tracker', then assert that it ran on one of 'labeled_nodes'
+        tracker.wait_within_short()
+        assert build.built_on in labeled_nodes
         # EndTask
 
+        timings.record_metric('build_queue_wait', build.queue_wait)
+
     @pytest.mark.lab_6
+    @pytest.mark.needs_vms
     def test_collect_and_verify_artifacts_from_master(
         self, tmpdir, jenkins_master, dev_job
     ):
         local_artifact_path = os.path.join(str(tmpdir), 'dummy_artifact')
-        remote_artifact_path = os.path.join(dev_job.latest_art_path, 'dummy_artifact')
 
-        # Task: Create a function which copies the artifacts from 'remote_artifact_path'
-        # on jenkins_master to 'local_artifact_path'
-        # Hint: Use functools.partial and the instance method 'copy_from'
+        # Task: Create a function 'f' which fetches the archived artifacts
+        # under 'dev_job.latest_art_path' on jenkins_master into 'tmpdir'
+        # Hint: Use functools.partial and testlib.fetch_archive
         f = functools.partial(
-            jenkins_master.copy_from,
-            remote_artifact_path,
-            local_artifact_path
+            testlib.fetch_archive,
+            jenkins_master,
+            dev_job.latest_art_path,
+            str(tmpdir)
         )
         # EndTask
 
-        testlib.allow_exceptions_within_short(f, [scp.SCPException])
+        testlib.allow_exceptions_within_short(f, [RuntimeError])
 
         with open(local_artifact_path, mode='rt') as f:
             result = f.read()
@@ -299,3 +296,40 @@ class TestJenkins(object):
     @pytest.mark.lab_7
     def test_trigger_blank_job(self, jenkins_api, blank_job):
         jenkins_api.build_job(blank_job.name)
+
+    @pytest.mark.load
+    def test_build_throughput(
+        self, request, jenkins_api, labels, jenkins_events, console_log,
+        func_results_path
+    ):
+        builds = request.config.getoption('--load-builds')
+        if not builds:
+            pytest.skip('--load-builds was not given')
+
+        template = job_factory.JobTemplate(jenkins.EMPTY_CONFIG_XML)
+        factory = job_factory.JobFactory(jenkins_api)
+        jobs = {}
+        for label in set(label for label in labels if label):
+            name = 'load_{}_job'.format(label)
+            factory.add(
+                name,
+                template,
+                label=label,
+                command='sleep 5',
+                concurrent=True,
+                builds_to_keep=builds,
+            )
+            jobs[name] = label
+        factory.apply()
+
+        report = loadgen.LoadGenerator(
+            jenkins_api,
+            jobs,
+            builds,
+            request.config.getoption('--load-rate'),
+            events=jenkins_events,
+            console=console_log,
+        ).run()
+        report.write(os.path.join(func_results_path, 'load_report.json'))
+
+        assert report.summary()['failed'] == 0
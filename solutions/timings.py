@@ -0,0 +1 @@
+../jenkins-system-tests/timings.py
\ No newline at end of file